@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+compfits.py
+
+Parallel, slab-at-a-time reading of tile-compressed FITS images
+(fpack/RICE, i.e. astropy CompImageHDU).
+
+fits.getdata decompresses the whole image serially before anything
+else can happen. CompressedCube instead decodes only the tiles that
+cover the requested slab, splitting the work across a pool of worker
+processes, so decompression scales with cores and the fully decoded
+cube never has to be held in memory.
+
+Requires an astropy recent enough to support CompImageHDU.section.
+
+Example Use
+-----------
+import compfits
+
+ext = compfits.find_compressed("ngc1333_co.fits.fz")
+if ext is not None:
+    cube = compfits.CompressedCube("ngc1333_co.fits.fz", ext)
+    plane = cube[10]
+    cube.close()
+"""
+
+import numpy as np
+
+# Decoded HDU held by each worker process, see _init_worker
+_worker_hdu = None
+
+class CompFitsError(Exception):
+    """Exceptions for the compressed FITS reader."""
+    pass
+
+def find_compressed(filename):
+    """Return the index of the first tile-compressed image HDU in
+    filename, or None if there is none (or it isn't a FITS file)."""
+    from astropy.io import fits
+    try:
+        hdulist = fits.open(filename)
+    except (IOError, OSError):
+        return None
+    try:
+        for i, hdu in enumerate(hdulist):
+            if isinstance(hdu, fits.CompImageHDU):
+                return i
+    finally:
+        hdulist.close()
+    return None
+
+def _open_hdu(filename, ext):
+    """Return the opened HDUList and its compressed image HDU."""
+    from astropy.io import fits
+    hdulist = fits.open(filename)
+    hdu = hdulist[ext]
+    if not hasattr(hdu, 'section'):
+        hdulist.close()
+        raise CompFitsError('This version of astropy cannot decompress '
+                            'individual tiles (no CompImageHDU.section).')
+    return hdulist, hdu
+
+def _init_worker(filename, ext):
+    global _worker_hdu
+    hdulist, _worker_hdu = _open_hdu(filename, ext)
+
+def _decode(key):
+    return np.asarray(_worker_hdu.section[key])
+
+def _normalize_key(key, shape):
+    """Turn an index into a list of (start, stop) pairs, one per axis,
+    and the axes that were indexed by an integer (and must be dropped).
+    Only integers, slices with step 1 and Ellipsis are supported."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+    if ellipsis:
+        i = ellipsis[0]
+        key = (key[:i] + (slice(None),)*(len(shape)-len(key)+1) +
+               key[i+1:])
+    key = key + (slice(None),)*(len(shape)-len(key))
+    if len(key) != len(shape):
+        raise IndexError('Too many indices for a %d-d cube.' % len(shape))
+    bounds = []
+    dropped = []
+    for axis, (k, n) in enumerate(zip(key, shape)):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            if step != 1:
+                raise IndexError('Only contiguous slices are supported.')
+            bounds.append((start, max(start, stop)))
+        else:
+            k = int(k)
+            if k < 0:
+                k += n
+            if not 0 <= k < n:
+                raise IndexError('Index %d out of range for axis %d.' %
+                                 (k, axis))
+            bounds.append((k, k+1))
+            dropped.append(axis)
+    return bounds, dropped
+
+class CompressedCube(object):
+    """Lazily-decompressed view of a tile-compressed image HDU.
+
+    Indexing the cube (integers, contiguous slices and Ellipsis)
+    returns a native-endian ndarray with BSCALE/BZERO (and any extra
+    `scale`) applied. Each request is split along its slowest axis, so
+    that pieces cover distinct tiles for the usual row tiling, and
+    decoded by `workers` processes (default: one per core); workers=1
+    decodes in this process. Call close() to shut the pool down.
+    """
+
+    def __init__(self, filename, ext=1, scale=1., workers=None):
+        import multiprocessing
+        self.filename = filename
+        self.ext = ext
+        self.scale = scale
+        self._hdulist, self._hdu = _open_hdu(filename, ext)
+        self.header = self._hdu.header
+        self.shape = tuple(self._hdu.shape)
+        self.ndim = len(self.shape)
+        # Decode a single element to learn the output type
+        sample = np.asarray(self._hdu.section[(slice(0, 1),)*self.ndim])
+        if scale != 1:
+            sample = sample*scale
+        self.dtype = sample.dtype.newbyteorder('=')
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self._pool = None
+        if workers > 1:
+            self._pool = multiprocessing.Pool(workers,
+                                              initializer=_init_worker,
+                                              initargs=(filename, ext))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        bounds, dropped = _normalize_key(key, self.shape)
+        extents = [stop-start for start, stop in bounds]
+        if self._pool is None or max(extents) < 2:
+            pieces = [np.asarray(self._hdu.section[
+                tuple(slice(start, stop) for start, stop in bounds)])]
+            axis = 0
+        else:
+            # Several pieces per worker keeps the pool busy when tiles
+            # decode at different speeds
+            axis = [i for i, n in enumerate(extents) if n > 1][0]
+            start, stop = bounds[axis]
+            npieces = min(extents[axis], 4*self.workers)
+            edges = np.linspace(start, stop, npieces+1).astype(int)
+            keys = []
+            for lo, hi in zip(edges[:-1], edges[1:]):
+                piece = list(bounds)
+                piece[axis] = (lo, hi)
+                keys.append(tuple(slice(a, b) for a, b in piece))
+            pieces = self._pool.map(_decode, keys)
+        data = np.concatenate(pieces, axis=axis).astype(self.dtype,
+                                                        copy=False)
+        if self.scale != 1:
+            data *= self.dtype.type(self.scale)
+        if dropped:
+            data = data[tuple(0 if i in dropped else slice(None)
+                              for i in range(self.ndim))]
+        return data
+
+    def close(self):
+        """Shut down the worker pool and close the file."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._hdulist.close()
@@ -23,6 +23,12 @@ fits2itk.convert(infile,outfile)
 
 fits2itk.convert(infile,outfile,vel_scale=1,use_conv="ngc1333_conv")
 
+# combine several lines on the same grid into one
+# vector-valued NRRD file
+
+fits2itk.convert_multi(["ngc1333_13co.fits","ngc1333_c18o.fits"],
+                       "ngc1333_lines.nrrd")
+
 You can use the included strip_fourth_header.py to remove
 any polarization axis present in your data.
 
@@ -38,18 +44,40 @@ with the following options
 -u : Use Conv     -- Use the specified fixed/external conversion (opt)
 -s : Strip Pol    -- Strip out the fourth polarization header
                      Does not alter original FITS file
+-j : Workers      -- Processes used to decompress tile-compressed
+                     input (opt, default: one per core)
+-e : Encoding     -- NRRD encoding: raw (default), gzip, bz2 or auto
+                     (auto picks one by sampling the cube) (opt)
+-r : Reference    -- Only write a .nhdr header that points into the
+                     FITS file instead of copying the data (opt)
+-g : Gzip members -- Bytes per gzip member; smaller members make
+                     reading single channels cheaper (opt)
 -h : Help         -- Display this help
 
 """
 
-import nrrd
-from astropy.io import fits
-import numpy as np
-import importlib 
 import sys,os,getopt
-import strip_fourth_fits_header
 
-def convert(infile,outfile,data_scale=1.,vel_scale=False,use_conv=False):
+# astropy, numpy and the nrrd writer are imported inside the functions
+# that use them, so that "-h" and pure NRRD work do not pay their
+# import cost at startup.
+
+# Bytes reserved in written headers, so reregister() can update them
+# in place
+HEADER_PADDING = 1024
+
+# Gzip output is written as independent members, so nrrd.read_subvolume
+# can decode parts of it without inflating it all. A velocity channel has
+# one row in every RA x Vel plane, and reading it inflates about half a
+# member per plane. Unless convert() is given gzip_member_bytes, members
+# get a sixteenth of a plane (so a channel costs ~1/32 of the cube),
+# within these limits (below ~64 KB compression starts to suffer).
+GZIP_MEMBER_BYTES = 4*1024*1024
+GZIP_MIN_MEMBER_BYTES = 64*1024
+
+def convert(infile,outfile,data_scale=1.,vel_scale=False,use_conv=False,
+            workers=None,mode='copy',encoding='raw',encoding_targets=None,
+            gzip_member_bytes=None):
     """
     Parameters
     ----------
@@ -79,13 +107,232 @@ def convert(infile,outfile,data_scale=1.,vel_scale=False,use_conv=False):
         the cubes in km/s and vel_scale = 1. for the cubes
         in m/s.). Always specify vel_scale when using this
         option.
+
+    workers: Number of processes for decompression, optional
+        Tile-compressed (fpack/RICE) input is decompressed a slab
+        at a time in parallel, using this many worker processes.
+        Defaults to one per core.
+
+    mode: 'copy' or 'reference', optional
+        'copy' (the default) writes the voxels to a new NRRD file.
+        'reference' writes only a detached header (.nhdr) whose
+        data file is the FITS file itself, which takes no time and
+        no disk space. This needs an uncompressed 3-axis primary
+        HDU without BSCALE/BZERO, and data_scale must be 1.
+
+    encoding: NRRD encoding, optional
+        'raw' (the default) allows import in paraview. 'gzip' files
+        can be a lot smaller, depending on the cube. 'auto' samples
+        the cube and picks the encoding that best meets
+        encoding_targets; see nrrd.choose_encoding for the targets
+        (e.g. {'min_saving':0.2,'min_write_mbps':50.}).
+
+    gzip_member_bytes: Size of the gzip members, optional
+        gzip output is split into independently compressed members of
+        this many bytes, so parts can be read without inflating the
+        whole file (see nrrd.read_subvolume). Reading one velocity
+        channel inflates about half a member per RA x Vel plane, so
+        smaller members make channel previews cheaper, at the cost of
+        a larger file and index (16 KB members cost ~5%, 4 KB ~20%).
+        Defaults to a sixteenth of a plane, see GZIP_MEMBER_BYTES.
         
     """
+    import nrrd
+    import rawfits
+
+    if mode not in ('copy','reference'):
+        raise ValueError("Unknown mode: %s" % mode)
+    if mode == 'reference':
+        # Only the header is needed; never load or decompress the data
+        cube = None
+        if rawfits.qualifies(infile):
+            cube = rawfits.PrimaryCube(infile,scale=data_scale or 1.)
+        if (cube is None or cube.ndim != 3 or
+            cube.bscale != 1 or cube.bzero != 0):
+            if cube is not None:
+                cube.close()
+            raise ValueError("mode='reference' needs an uncompressed, "
+                             "unscaled 3-axis primary HDU: %s" % infile)
+        h = cube.header
+    else:
+        d,h,cube = _open_cube(infile,data_scale,workers)
+
+    options = {}
+    options['space'] = 'left-posterior-superior'
+    options['space directions'],options['space origin'] = \
+        _geometry(h,vel_scale,use_conv)
+    options['kinds'] = ['domain','domain','domain']
+
+    if mode == 'reference':
+        # The FITS data block already is a raw, big-endian nrrd payload
+        # with RA fastest, then Dec, then Velocity. Reorder the space
+        # directions to match instead of reordering the voxels.
+        options['space directions'] = _reference_directions(
+            options['space directions'])
+        if outfile[-5:] == '.nrrd':
+            outfile = outfile[:-4] + 'nhdr'
+        datafile = os.path.relpath(os.path.abspath(infile),
+                        os.path.dirname(os.path.abspath(outfile)))
+        print(options)
+        nrrd.write_header(outfile,cube.raw.T,datafile,options=options,
+                          byteskip=cube.offset)
+        cube.close()
+        return
+
+    options['encoding'] = encoding
+    print(options)
+    try:
+        nrrd.write(outfile,d,options=options,header_padding=HEADER_PADDING,
+                   encoding_targets=encoding_targets,
+                   gzip_member_bytes=(gzip_member_bytes or
+                                      _gzip_member_bytes(d)))
+    finally:
+        if cube is not None:
+            cube.close()
     
-    d,h = fits.getdata(infile,header=True)
+def convert_multi(infiles,outfile,data_scale=1.,vel_scale=False,
+                  use_conv=False,workers=None,encoding='raw',
+                  encoding_targets=None,gzip_member_bytes=None):
+    """
+    Convert several co-registered cubes (e.g. different spectral lines
+    on the same grid) into one vector-valued NRRD file.
+
+    The cubes are read in lockstep, a slab at a time, and written
+    interleaved: each voxel of the output holds one value per input
+    file, along a leading 'vector' axis. Slicer then loads a single
+    file instead of one per line.
+
+    All cubes must be on the same grid (same NAXISn, CTYPEn, CRVALn,
+    CDELTn and CRPIXn); this is checked from the headers before any
+    data is read, and a ValueError is raised if they differ.
+
+    Parameters
+    ----------
+
+    data_scale: A single value, or one value per input file, by which
+        to scale the intensities. See convert().
+
+    vel_scale, use_conv, workers, encoding, encoding_targets,
+    gzip_member_bytes: See convert().
+    """
+    import numpy as np
+    import nrrd
+
+    headers = [_read_fits_header(f) for f in infiles]
+    _check_grids(infiles,headers)
+    try:
+        data_scales = list(data_scale)
+    except TypeError:
+        data_scales = [data_scale]*len(infiles)
+    if len(data_scales) != len(infiles):
+        raise ValueError("Need one data_scale per input file")
+
+    data = []
+    cubes = []
+    try:
+        for infile,scale in zip(infiles,data_scales):
+            d,h,cube = _open_cube(infile,scale,workers)
+            data.append(d)
+            cubes.append(cube)
+        d = _StackedCubes(data)
+
+        options = {}
+        options['space'] = 'left-posterior-superior'
+        directions,options['space origin'] = \
+            _geometry(headers[0],vel_scale,use_conv)
+        options['space directions'] = ['none'] + directions
+        options['kinds'] = ['vector','domain','domain','domain']
+        options['encoding'] = encoding
+        print(options)
+        nrrd.write(outfile,d,options=options,header_padding=HEADER_PADDING,
+                   encoding_targets=encoding_targets,
+                   gzip_member_bytes=(gzip_member_bytes or
+                                      _gzip_member_bytes(d)))
+    finally:
+        for cube in cubes:
+            if cube is not None:
+                cube.close()
+
+def _gzip_member_bytes(d):
+    """Gzip member size for the nrrd-ordered data d, see GZIP_MEMBER_BYTES."""
+    plane = d.dtype.itemsize
+    for n in d.shape[:-1]:
+        plane *= n
+    return(max(GZIP_MIN_MEMBER_BYTES,min(GZIP_MEMBER_BYTES,plane//16)))
+
+def _open_cube(infile,data_scale=1.,workers=None):
+    """
+    Open the cube in infile for conversion.
+
+    Returns (d,h,cube): the (scaled) data, with its axes in the
+    RA, Velocity, Dec order that is written out; the FITS header;
+    and the lazily-read cube d reads from, or None if the file was
+    read with astropy. The cube must be closed when done.
+    """
+    import numpy as np
+    import rawfits
+    import compfits
+
+    cube = None
+    if rawfits.qualifies(infile):
+        cube = rawfits.PrimaryCube(infile,scale=data_scale or 1.)
+    else:
+        ext = compfits.find_compressed(infile)
+        if ext is not None:
+            try:
+                cube = compfits.CompressedCube(infile,ext,
+                                               scale=data_scale or 1.,
+                                               workers=workers)
+            except compfits.CompFitsError:
+                # Old astropy: decompress it all the usual way
+                pass
+    if cube is not None and cube.ndim == 3:
+        # Plain or tile-compressed cube: let nrrd.write pull scaled
+        # slabs straight from the file, decoding them as it goes.
+        d,h = cube,cube.header
+    else:
+        from astropy.io import fits
+        d,h = fits.getdata(infile,header=True)
+        if data_scale:
+            d *= data_scale
     
-    if data_scale:
-        d *= data_scale
+    #Assume FITS order is RA,Dec,Velocity
+    #Numpy order is Velocity, Dec, RA
+    #Slicer wants RA, Velocity, Dec
+    if isinstance(d,np.ndarray):
+        d = np.swapaxes(d,0,1)
+        d = np.swapaxes(d,0,2)
+    else:
+        d = _TransposedCube(d,(2,0,1))
+    return(d,h,cube)
+
+def _check_grids(infiles,headers):
+    """Raise a ValueError unless all headers describe the same grid."""
+    keywords = ['NAXIS']
+    for n in (1,2,3):
+        keywords += ['NAXIS%d' % n,'CTYPE%d' % n,'CRVAL%d' % n,
+                     'CDELT%d' % n,'CRPIX%d' % n]
+    for infile,h in zip(infiles[1:],headers[1:]):
+        for key in keywords:
+            a,b = headers[0].get(key),h.get(key)
+            if isinstance(a,float) or isinstance(b,float):
+                same = (a is not None and b is not None and
+                        abs(a-b) <= 1e-6*max(abs(a),abs(b)))
+            else:
+                same = a == b
+            if not same:
+                raise ValueError("%s and %s are not on the same grid: "
+                                 "%s is %s and %s" % (infiles[0],infile,
+                                                      key,a,b))
+
+def _geometry(h,vel_scale,use_conv):
+    """
+    Space directions and origin for the cube with FITS header h,
+    with the axes in the RA, Velocity, Dec order convert() writes.
+    See convert() for vel_scale and use_conv.
+    """
+    import numpy as np
+
     if not vel_scale: #Determine scale automatically
         vel_scale = 1.
     elif vel_scale == 'auto':
@@ -102,21 +349,11 @@ def convert(infile,outfile,data_scale=1.,vel_scale=False,use_conv=False):
     
     if vel_scale != 1 and not use_conv:
         dvel = dvel/vel_scale
-        
-    
-    #Assume FITS order is RA,Dec,Velocity
-    #Numpy order is Velocity, Dec, RA
-    #Slicer wants RA, Velocity, Dec
-    d = np.swapaxes(d,0,1)
-    d = np.swapaxes(d,0,2)
-    #options = {'encoding':'raw'}
-    
-    #Want the _center_ of the cube at 0
-    spaceorigin = -1*np.array(d.shape)/2.
 
     if use_conv:
         # This line imports the dictionary defined in your convention 
         # file. The example included is called "ngc1333_conv"
+        import importlib
         i = importlib.import_module(use_conv)
         dra  = h['CDELT1']*i.c_dict['ra-mm']
         ddec = h['CDELT2']*i.c_dict['dec-mm']
@@ -129,23 +366,102 @@ def convert(infile,outfile,data_scale=1.,vel_scale=False,use_conv=False):
         deccenter = -1*((dec0-h['CRVAL2'])/h['CDELT2']+h['CRPIX2'])
         velcenter = -1*((vel0-h['CRVAL3'])/(h['CDELT3'])+h['CRPIX3'])
 
-    options = {}
-    options['space'] = 'left-posterior-superior'
-    options['space directions'] = [(-1*dra,0,0),(0,dvel,0),(0,0,ddec)]
-    options['kinds'] = ['domain','domain','domain']
-    spaceorigin[0] = racenter*dra
-    spaceorigin[1] = velcenter*dvel
-    spaceorigin[2] = deccenter*ddec
-    options['space origin'] = spaceorigin
-
-    #This could be an option. 'raw' allows import in paraview. 
-    #'gzip' files can be a lot smaller, depending on the cube.
-    options['encoding'] = 'raw'
-    print(options)
-    nrrd.write(outfile,d,options=options)
-    
+    directions = [(-1*dra,0,0),(0,dvel,0),(0,0,ddec)]
+    #Want the _center_ of the cube at 0 by default
+    spaceorigin = np.array([racenter*dra,velcenter*dvel,deccenter*ddec])
+    return(directions,spaceorigin)
+
+def _reference_directions(directions):
+    """
+    Reorder space directions from RA, Velocity, Dec to the
+    RA, Dec, Velocity axis order of a mode='reference' header.
+    """
+    ra_dir,vel_dir,dec_dir = directions
+    return([ra_dir,dec_dir,vel_dir])
+
+def _read_fits_header(infile):
+    """Read the header of the cube in infile, as convert() would."""
+    import rawfits
+    import compfits
+    if rawfits.qualifies(infile):
+        with open(infile,'rb') as f:
+            h,offset = rawfits.read_header(f)
+        return(h)
+    from astropy.io import fits
+    ext = compfits.find_compressed(infile)
+    if ext is not None:
+        return(fits.getheader(infile,ext))
+    return(fits.getheader(infile))
+
+def reregister(infile,nrrdfile,vel_scale=False,use_conv=False):
+    """
+    Update the registration of an existing conversion of infile
+    without rewriting its voxel data.
+
+    Use this after changing vel_scale or the use_conv convention:
+    only 'space directions' and 'space origin' are recomputed (from
+    the FITS header alone) and rewritten with nrrd.update_header.
+    Files written by convert() reserve header space for this, so
+    the update is done in place. Works for both the copy and the
+    reference mode of convert(), and for convert_multi() output.
+    """
+    import nrrd
+
+    h = _read_fits_header(infile)
+    directions,spaceorigin = _geometry(h,vel_scale,use_conv)
+    with open(nrrdfile,'rb') as f:
+        fields = nrrd.read_header(f)
+    datafile = fields.get('data file',fields.get('datafile',None))
+    if datafile is not None:
+        datafile = os.path.join(os.path.dirname(nrrdfile),datafile)
+        if os.path.abspath(datafile) == os.path.abspath(infile):
+            directions = _reference_directions(directions)
+    if fields.get('kinds',[''])[0] == 'vector':
+        # Written by convert_multi()
+        directions = ['none'] + directions
+    nrrd.update_header(nrrdfile,space_directions=directions,
+                       space_origin=spaceorigin)
+
+class _TransposedCube(object):
+    """
+    Transposed view of a lazily-read cube, e.g. a rawfits.PrimaryCube.
+
+    Only supports the d[...,start:stop] slicing that nrrd.write
+    uses, and reads just that slab of the underlying cube.
+    """
+    def __init__(self,cube,axes):
+        self.cube = cube
+        self.axes = tuple(axes)
+        self.shape = tuple(cube.shape[a] for a in self.axes)
+        self.ndim = cube.ndim
+        self.dtype = cube.dtype
+
+    def __getitem__(self,key):
+        index = [slice(None)]*self.ndim
+        index[self.axes[-1]] = key[-1]
+        return self.cube[tuple(index)].transpose(self.axes)
+
+class _StackedCubes(object):
+    """
+    Several cubes of the same shape, interleaved along a new leading
+    axis. Only supports the d[...,start:stop] slicing that nrrd.write
+    uses, reading the same slab of every cube.
+    """
+    def __init__(self,cubes):
+        import numpy as np
+        self.cubes = cubes
+        self.shape = (len(cubes),) + tuple(cubes[0].shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.result_type(*[c.dtype for c in cubes])
+
+    def __getitem__(self,key):
+        import numpy as np
+        return np.array([c[...,key[-1]] for c in self.cubes],
+                        dtype=self.dtype)
+
 def read(inputfile):
-    data,options = nrdd.read(inputfile)
+    import nrrd
+    data,options = nrrd.read(inputfile)
     return(data,options)
 
 def main():
@@ -157,6 +473,10 @@ def main():
     -u : Use Conv     -- Use the specified fixed/external conversion
     -s : Strip Pol    -- Strip out the fourth polarization header
                          Does not alter original FITS file
+    -j : Workers      -- Processes used to decompress tile-compressed input
+    -e : Encoding     -- NRRD encoding: raw, gzip, bz2 or auto
+    -r : Reference    -- Only write a .nhdr header pointing into the FITS file
+    -g : Gzip members -- Bytes per gzip member
     -h : Help         -- Display this help
     """
     infile, outfile = False, False
@@ -164,8 +484,8 @@ def main():
     kwargs = {}
     kwargs["vel_scale"] = "auto"
     try:
-        opts,args = getopt.getopt(sys.argv[1:],"i:o:d:v:u:sh")
-    except getopt.GetoptError,err:
+        opts,args = getopt.getopt(sys.argv[1:],"i:o:d:v:u:j:e:g:rsh")
+    except getopt.GetoptError as err:
         print(str(err))
         print(__doc__)
         sys.exit(2)
@@ -180,6 +500,14 @@ def main():
             kwargs["vel_scale"] = float(a)
         elif o == "-u":
             kwargs["use_conv"] = a
+        elif o == "-j":
+            kwargs["workers"] = int(a)
+        elif o == "-e":
+            kwargs["encoding"] = a
+        elif o == "-g":
+            kwargs["gzip_member_bytes"] = int(a)
+        elif o == "-r":
+            kwargs["mode"] = "reference"
         elif o == "-s":
             strip_pol = True
         elif o == "-h":
@@ -193,8 +521,13 @@ def main():
         assert False, "Input or Output file not specified"
         print(__doc__)
         sys.exit(2)
+    if strip_pol and kwargs.get("mode") == "reference":
+        print("-r can't be used with -s: the stripped copy is temporary")
+        print(__doc__)
+        sys.exit(2)
     print(kwargs)
     if strip_pol:
+        import strip_fourth_fits_header
         tempfile = "temp-strip-pol.fits"
         strip_fourth_fits_header.strip(infile,tempfile,clobber=True)
         convert(tempfile,outfile,**kwargs)
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fits2itk_service.py
+
+Watch a staging directory and convert FITS cubes to NRRD as they land.
+
+A file is converted once its size and modification time have been
+stable for a few seconds (no inotify needed). Files are deduplicated
+by a content key (confirmed by a full hash), so a cube that is copied
+in twice, or renamed, is only converted once. Conversions run in a bounded pool of worker
+processes, with per-file fits2itk.convert() parameters taken from a
+rules file. Status and latency metrics are written to a JSON file
+and/or served as JSON over HTTP on localhost.
+
+Requires Python 3 (asyncio).
+
+Can be run from the command line as
+python fits2itk_service.py -i incoming -o nrrd -r rules.json -s status.json
+
+with the following options
+
+-i : Indir        -- Directory to watch for FITS files (req)
+-o : Outdir       -- Directory to write the NRRD files to (req)
+-r : Rules        -- JSON rules file with convert() parameters (opt)
+-s : Status       -- JSON file for status and latency metrics of recent
+                     jobs (opt). Also remembers what was converted
+                     across restarts
+-p : Port         -- Serve the status JSON on http://localhost:port/ (opt)
+-n : Workers      -- Number of conversions run at once (opt, default 2)
+-t : Poll         -- Seconds between scans of Indir (opt, default 1)
+-q : Quiet        -- Seconds a file must be unchanged before it is
+                     converted (opt, default 2)
+-h : Help         -- Display this help
+
+Rules file
+----------
+A JSON list of rules. The first rule whose "pattern" matches the file
+name is used, and its other keys are passed to fits2itk.convert:
+
+[
+  {"pattern": "*13co10*", "vel_scale": 1.0, "use_conv": "ngc1333_conv"},
+  {"pattern": "*c18o32*", "vel_scale": 1000.0, "use_conv": "ngc1333_conv"},
+  {"pattern": "*", "vel_scale": "auto"}
+]
+
+Files matching no rule are ignored. Without a rules file every FITS
+file is converted with the defaults of convert(). Unless a rule sets
+"workers", compressed input is decompressed by a single process per
+job, since the service already runs several jobs at once.
+
+"""
+
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import fnmatch
+import getopt
+import hashlib
+import json
+import os
+import sys
+import time
+
+FITS_PATTERNS = ['*.fits','*.fit','*.fts','*.fits.fz','*.fz']
+
+# Number of recent latencies kept for the percentiles in the status
+LATENCY_HISTORY = 1000
+
+# Number of finished jobs kept in the status; running ones are always kept
+JOB_HISTORY = 1000
+
+FINISHED_STATES = ('done','failed','duplicate','ignored')
+
+def load_rules(filename):
+    """Read a rules file, see the module docstring."""
+    with open(filename) as f:
+        rules = json.load(f)
+    if not isinstance(rules,list):
+        raise ValueError("Rules file must contain a JSON list: %s" % filename)
+    for rule in rules:
+        if not isinstance(rule,dict) or 'pattern' not in rule:
+            raise ValueError("Every rule needs a 'pattern': %s" % rule)
+    return(rules)
+
+def match_rule(rules,name):
+    """
+    Return the convert() keyword arguments for the file called name,
+    or None if no rule matches. rules=None matches everything.
+    """
+    if rules is None:
+        return({})
+    for rule in rules:
+        if fnmatch.fnmatch(name,rule['pattern']):
+            kwargs = dict(rule)
+            del kwargs['pattern']
+            return(kwargs)
+    return(None)
+
+def _header_bytes(f):
+    """Number of bytes at the start of the FITS file f taken up by its
+    header (and, if the primary HDU has no data, as for fpack files,
+    the first extension header), or 0 if it can't be parsed."""
+    import rawfits
+    try:
+        header,offset = rawfits.read_header(f)
+        if header.get('NAXIS',0) == 0:
+            extension,length = rawfits.read_header(f)
+            offset += length
+    except rawfits.RawFitsError:
+        return(0)
+    return(offset)
+
+def content_key(filename,samples=16,blocksize=65536):
+    """
+    Cheap content key for a (possibly huge) file.
+
+    SHA-1 of the file size, the whole FITS header, the last block and
+    evenly spaced blocks in between, so that hashing takes milliseconds
+    rather than reading the whole cube. Files with the same key may
+    still differ; see file_sha1.
+    """
+    size = os.path.getsize(filename)
+    sha = hashlib.sha1(str(size).encode('ascii'))
+    with open(filename,'rb') as f:
+        headersize = _header_bytes(f)
+        f.seek(0)
+        sha.update(f.read(headersize))
+        step = max(blocksize,size//samples)
+        for offset in list(range(0,size,step)) + [max(0,size-blocksize)]:
+            f.seek(offset)
+            sha.update(f.read(blocksize))
+    return(sha.hexdigest())
+
+def file_sha1(filename,blocksize=1024*1024):
+    """SHA-1 of the whole file, to confirm that a key match is a duplicate."""
+    sha = hashlib.sha1()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(blocksize),b''):
+            sha.update(block)
+    return(sha.hexdigest())
+
+def output_name(infile,outdir):
+    """The NRRD file that infile is converted to."""
+    name = os.path.basename(infile)
+    if name.endswith('.fz'):
+        name = name[:-3]
+    name = os.path.splitext(name)[0]
+    return(os.path.join(outdir,name + '.nrrd'))
+
+def _convert_job(infile,outfile,kwargs):
+    """
+    Run one conversion. Runs in a worker process. Returns the output
+    file and the file_sha1 of infile (read while it is still cached).
+    """
+    import fits2itk
+    if kwargs.get('mode') == 'reference':
+        # Only a small header is written, straight to its final name
+        fits2itk.convert(infile,outfile,**kwargs)
+        return(outfile[:-4] + 'nhdr',file_sha1(infile))
+    # Write under a temporary name, so a .nrrd is always complete
+    partfile = outfile + '.part'
+    fits2itk.convert(infile,partfile,**kwargs)
+    # Gzip output comes with a member index (see nrrd.write); move it
+    # along, and never leave the index of an older output behind
+    if os.path.exists(partfile + '.gzidx'):
+        os.rename(partfile + '.gzidx',outfile + '.gzidx')
+    elif os.path.exists(outfile + '.gzidx'):
+        os.remove(outfile + '.gzidx')
+    os.rename(partfile,outfile)
+    return(outfile,file_sha1(infile))
+
+def _percentile(values,q):
+    values = sorted(values)
+    return(values[min(len(values)-1,int(q*len(values)))])
+
+class WatchService(object):
+    """
+    Watches indir and converts FITS files that land there to NRRD
+    files in outdir. See the module docstring for the options.
+    """
+    def __init__(self,indir,outdir,rules=None,status_file=None,port=None,
+                 workers=2,poll=1.,settle=2.):
+        self.indir = indir
+        self.outdir = outdir
+        self.rules = rules
+        self.status_file = status_file
+        self.port = port
+        self.workers = workers
+        self.poll = poll
+        self.settle = settle
+        self.started = time.time()
+        # path -> ((size,mtime), time that signature was first seen)
+        self._candidates = {}
+        # path -> (size,mtime) of the version already dealt with
+        self._handled = {}
+        # content key -> {'output':file,'sha1':file_sha1 of the input},
+        # for converted or running jobs (sha1 is None until converted)
+        self.keys = {}
+        # path -> status of the latest job for that file, oldest first
+        self.jobs = {}
+        # Running _handle tasks, referenced so they aren't collected
+        self._tasks = set()
+        self.latencies = []
+        self._semaphore = None
+        self._executor = None
+        if status_file is not None and os.path.exists(status_file):
+            with open(status_file) as f:
+                for key,entry in json.load(f).get('keys',{}).items():
+                    if not isinstance(entry,dict):
+                        # Written before full hashes were kept
+                        entry = {'output':entry,'sha1':None}
+                    self.keys[key] = entry
+
+    def run(self):
+        """Run until interrupted."""
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            pass
+
+    async def _main(self):
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        server = None
+        if self.port is not None:
+            server = await asyncio.start_server(self._serve_status,
+                                                '127.0.0.1',self.port)
+        try:
+            while True:
+                self.scan()
+                await asyncio.sleep(self.poll)
+        finally:
+            if server is not None:
+                server.close()
+            self._executor.shutdown(wait=True)
+
+    def scan(self):
+        """Start jobs for files in indir that have stopped changing."""
+        now = time.time()
+        for name in sorted(os.listdir(self.indir)):
+            if not any(fnmatch.fnmatch(name,p) for p in FITS_PATTERNS):
+                continue
+            path = os.path.join(self.indir,name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature = (st.st_size,st.st_mtime)
+            if self._handled.get(path) == signature:
+                continue
+            seen = self._candidates.get(path)
+            if seen is None or seen[0] != signature:
+                self._candidates[path] = (signature,now)
+                continue
+            if now - seen[1] < self.settle:
+                continue
+            del self._candidates[path]
+            self._handled[path] = signature
+            task = asyncio.ensure_future(self._handle(path,st.st_mtime,now))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self,task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            err = task.exception()
+            print("fits2itk_service: job failed: %s: %s" %
+                  (type(err).__name__,err),file=sys.stderr)
+
+    async def _handle(self,path,landed,detected):
+        loop = asyncio.get_running_loop()
+        job = {'state':'hashing','landed':landed,'detected':detected}
+        self.jobs.pop(path,None)
+        self.jobs[path] = job
+        try:
+            key = await loop.run_in_executor(None,content_key,path)
+        except OSError as err:
+            job.update(state='failed',error=str(err))
+            self.write_status()
+            return
+        job['key'] = key
+        known = self.keys.get(key)
+        if known is not None and known['sha1'] is not None:
+            # The key only samples the file: confirm with a full hash
+            try:
+                sha1 = await loop.run_in_executor(None,file_sha1,path)
+            except OSError as err:
+                job.update(state='failed',error=str(err))
+                self.write_status()
+                return
+            if sha1 == known['sha1']:
+                job.update(state='duplicate',output=known['output'])
+                self.write_status()
+                return
+        kwargs = match_rule(self.rules,os.path.basename(path))
+        if kwargs is None:
+            job['state'] = 'ignored'
+            self.write_status()
+            return
+        kwargs.setdefault('workers',1)
+        outfile = output_name(path,self.outdir)
+        self.keys[key] = {'output':outfile,'sha1':None}
+        job['state'] = 'queued'
+        self.write_status()
+        async with self._semaphore:
+            job.update(state='running',started=time.time())
+            self.write_status()
+            try:
+                outfile,sha1 = await self._run_job(path,outfile,kwargs)
+            except Exception as err:
+                # Forget the key, so a corrected file is converted again
+                if known is None:
+                    del self.keys[key]
+                else:
+                    self.keys[key] = known
+                for leftover in (outfile + '.part',outfile + '.part.gzidx'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                job.update(state='failed',error=str(err),
+                           finished=time.time())
+                self.write_status()
+                return
+        finished = time.time()
+        self.keys[key] = {'output':outfile,'sha1':sha1}
+        job.update(state='done',output=outfile,finished=finished,
+                   latency=finished-landed)
+        self.latencies = (self.latencies + [finished-landed])[-LATENCY_HISTORY:]
+        self.write_status()
+
+    async def _run_job(self,path,outfile,kwargs):
+        """Run _convert_job in the pool, surviving workers that die."""
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return(await loop.run_in_executor(executor,_convert_job,
+                                              path,outfile,kwargs))
+        except concurrent.futures.process.BrokenProcessPool:
+            pass
+        # A worker died (killed for running out of memory, crashed),
+        # which breaks the pool and fails every job running in it.
+        # Replace the pool, and retry this job in a process of its own
+        # so that only the job that kills its worker fails.
+        if self._executor is executor:
+            print("fits2itk_service: a worker died, restarting the pool",
+                  file=sys.stderr)
+            executor.shutdown(wait=False)
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers)
+        alone = concurrent.futures.ProcessPoolExecutor(1)
+        try:
+            return(await loop.run_in_executor(alone,_convert_job,
+                                              path,outfile,kwargs))
+        except concurrent.futures.process.BrokenProcessPool:
+            raise RuntimeError("The conversion process died (killed or "
+                               "crashed) while converting %s" % path)
+        finally:
+            alone.shutdown(wait=False)
+
+    def _prune_jobs(self):
+        """Forget the oldest finished jobs beyond JOB_HISTORY."""
+        finished = [path for path,job in self.jobs.items()
+                    if job['state'] in FINISHED_STATES]
+        for path in finished[:max(0,len(finished)-JOB_HISTORY)]:
+            del self.jobs[path]
+
+    def status(self):
+        """The status and latency metrics, as a JSON-able dict."""
+        counts = {}
+        for job in self.jobs.values():
+            counts[job['state']] = counts.get(job['state'],0) + 1
+        latency = {'count':len(self.latencies)}
+        if self.latencies:
+            latency.update(mean=sum(self.latencies)/len(self.latencies),
+                           p50=_percentile(self.latencies,0.5),
+                           p95=_percentile(self.latencies,0.95),
+                           max=max(self.latencies),
+                           last=self.latencies[-1])
+        return({'indir':self.indir,'outdir':self.outdir,
+                'started':self.started,'updated':time.time(),
+                'counts':counts,'latency':latency,
+                'jobs':self.jobs,'keys':self.keys})
+
+    def write_status(self):
+        """Atomically rewrite the status file, if there is one."""
+        self._prune_jobs()
+        if self.status_file is None:
+            return
+        tmpfile = self.status_file + '.tmp'
+        with open(tmpfile,'w') as f:
+            json.dump(self.status(),f,indent=1,sort_keys=True)
+        os.replace(tmpfile,self.status_file)
+
+    async def _serve_status(self,reader,writer):
+        # Any request gets the status; skip the request and its headers
+        line = await reader.readline()
+        while line.strip():
+            line = await reader.readline()
+        body = json.dumps(self.status(),sort_keys=True).encode('utf-8')
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: application/json\r\n' +
+                     ('Content-Length: %d\r\n\r\n' % len(body)).encode('ascii') +
+                     body)
+        await writer.drain()
+        writer.close()
+
+def main():
+    """
+    -i : Indir        -- Directory to watch for FITS files
+    -o : Outdir       -- Directory to write the NRRD files to
+    -r : Rules        -- JSON rules file with convert() parameters
+    -s : Status       -- JSON file for status and latency metrics
+    -p : Port         -- Serve the status JSON on http://localhost:port/
+    -n : Workers      -- Number of conversions run at once
+    -t : Poll         -- Seconds between scans of Indir
+    -q : Quiet        -- Seconds a file must be unchanged before conversion
+    -h : Help         -- Display this help
+    """
+    indir, outdir = False, False
+    kwargs = {}
+    try:
+        opts,args = getopt.getopt(sys.argv[1:],"i:o:r:s:p:n:t:q:h")
+    except getopt.GetoptError as err:
+        print(str(err))
+        print(__doc__)
+        sys.exit(2)
+    for o,a in opts:
+        if o == "-i":
+            indir = a
+        elif o == "-o":
+            outdir = a
+        elif o == "-r":
+            kwargs["rules"] = load_rules(a)
+        elif o == "-s":
+            kwargs["status_file"] = a
+        elif o == "-p":
+            kwargs["port"] = int(a)
+        elif o == "-n":
+            kwargs["workers"] = int(a)
+        elif o == "-t":
+            kwargs["poll"] = float(a)
+        elif o == "-q":
+            kwargs["settle"] = float(a)
+        elif o == "-h":
+            print(__doc__)
+            sys.exit(1)
+    if not indir or not outdir:
+        print("Input and Output directories must be specified")
+        print(__doc__)
+        sys.exit(2)
+    WatchService(indir,outdir,**kwargs).run()
+
+
+if __name__ == '__main__':
+    main()
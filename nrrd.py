@@ -13,12 +13,26 @@ import numpy as np
 import gzip
 import bz2
 import os.path
+import json
+import shutil
+import time
+import zlib
 from datetime import datetime
 
 class NrrdError(Exception):
     """Exceptions for Nrrd class."""
     pass
 
+def _header_text(line):
+    """Decode a header line read from a binary file (no-op on python 2)."""
+    if not isinstance(line, str):
+        line = line.decode('ascii')
+    return line
+
+def _header_bytes(text):
+    """Encode header text for writing to a binary file."""
+    return text.encode('ascii')
+
 def _nrrd_read_header_lines(nrrdfile):
     """Read header lines from a .nrrd/.nhdr file."""
     line = nrrdfile.readline()
@@ -152,6 +166,15 @@ _NRRD_FIELD_PARSERS = {
 
 _NRRD_REQUIRED_FIELDS = ['dimension', 'type', 'encoding', 'sizes']
 
+# Fields that determine how the data is laid out, see update_header()
+_NRRD_LAYOUT_FIELDS = ['dimension', 'type', 'encoding', 'sizes', 'endian',
+                       'lineskip', 'line skip', 'byteskip', 'byte skip',
+                       'datafile', 'data file']
+
+# Comment line used to reserve space in the header, see write()
+_HEADER_PADDING_COMMENT = '# padding reserved for header updates'
+_DEFAULT_HEADER_PADDING = 1024
+
 # The supported field values
 _NRRD_FIELD_ORDER = [
     'type',
@@ -204,27 +227,48 @@ def _determine_dtype(fields):
     return np.dtype(np_typestring)
 
 
-def read_data(fields, filehandle, filename=None):
-    """Read the actual data into a numpy structure."""
+def _open_data_file(fields, filehandle, filename=None):
+    """Return (datafilehandle, datafilename) for the data of a header."""
+    datafile = fields.get("datafile", fields.get("data file", None))
+    if datafile is None:
+        return (filehandle, filename)
+    # If the datafile path is absolute, don't muck with it. Otherwise
+    # treat the path as relative to the directory in which the detached
+    # header is in
+    if os.path.isabs(datafile):
+        datafilename = datafile
+    else:
+        datafilename = os.path.join(os.path.dirname(filename), datafile)
+    return (open(datafilename,'rb'), datafilename)
+
+
+def _readinto(fileobj, out):
+    """Fill the array `out` with bytes read from fileobj."""
+    view = memoryview(out).cast('B')
+    pos = 0
+    while pos < len(view):
+        nread = fileobj.readinto(view[pos:])
+        if not nread:
+            raise NrrdError('Data ends before all %d bytes were read.' %
+                            len(view))
+        pos += nread
+
+
+def read_data(fields, filehandle, filename=None, out=None):
+    """Read the actual data into a numpy structure.
+
+    If given, `out` is a 1-d array of the right dtype and size that the
+    data is read into (uncompressed data is read straight into it).
+    """
     data = np.zeros(0)
     # Determine the data type from the fields
     dtype = _determine_dtype(fields)
     # determine byte skip, line skip, and data file (there are two ways to write them)
     lineskip = fields.get('lineskip', fields.get('line skip', 0))
-    byteskip = fields.get('byteskip', fields.get('byteskip', 0))
-    datafile = fields.get("datafile", fields.get("data file", None))
-    datafilehandle = filehandle
-    if datafile is not None:
-        # If the datafile path is absolute, don't muck with it. Otherwise
-        # treat the path as relative to the directory in which the detached
-        # header is in
-        if os.path.isabs(datafile):
-            datafilename = datafile
-        else:
-            datafilename = os.path.join(os.path.dirname(filename), datafile)
-        datafilehandle = open(datafilename,'rb')
-    totalbytes = dtype.itemsize *\
-                    np.array(fields['sizes']).prod()
+    byteskip = fields.get('byteskip', fields.get('byte skip', 0))
+    datafilehandle = _open_data_file(fields, filehandle, filename)[0]
+    totalcount = int(np.array(fields['sizes']).prod())
+    totalbytes = dtype.itemsize * totalcount
     if fields['encoding'] == 'raw':
         if byteskip == -1:
             datafilehandle.seek(-totalbytes, 2)
@@ -232,23 +276,31 @@ def read_data(fields, filehandle, filename=None):
             for _ in range(lineskip):
                 datafilehandle.readline()
             datafilehandle.read(byteskip)
-        data = np.fromfile(datafilehandle, dtype)
+        # The data file may carry trailing bytes (e.g. FITS padding)
+        if out is None:
+            data = np.fromfile(datafilehandle, dtype, count=totalcount)
+        else:
+            _readinto(datafilehandle, out)
     elif fields['encoding'] == 'gzip' or\
          fields['encoding'] == 'gz':
         gzipfile = gzip.GzipFile(fileobj=datafilehandle)
         # Again, unfortunately, np.fromfile does not support
         # reading from a gzip stream, so we'll do it like this.
         # I have no idea what the performance implications are.
-        data = np.fromstring(gzipfile.read(), dtype)
+        if out is None:
+            data = np.frombuffer(gzipfile.read(), dtype).copy()
+        else:
+            _readinto(gzipfile, out)
     elif fields['encoding'] == 'bzip2' or\
          fields['encoding'] == 'bz2':
-        bz2file = bz2.BZ2File(fileobj=datafilehandle)
-        # Again, unfortunately, np.fromfile does not support
-        # reading from a gzip stream, so we'll do it like this.
-        # I have no idea what the performance implications are.
-        data = np.fromstring(bz2file.read(), dtype)
+        data = np.frombuffer(bz2.decompress(datafilehandle.read()),
+                             dtype).copy()
     else:
         raise NrrdError('Unsupported encoding: "%s"' % fields['encoding'])
+    if out is not None:
+        if fields['encoding'] in ('bzip2', 'bz2'):
+            out[...] = data
+        data = out
     # dkh : eliminated need to reverse order of dimensions. nrrd's
     # data layout is same as what numpy calls 'Fortran' order,
     shape_tmp = list(fields['sizes'])
@@ -264,7 +316,7 @@ def _validate_magic_line(line):
     try:
         if int(line[4:]) > 5:
             raise NrrdError('NRRD file version too new for this library.')
-    except Value:
+    except ValueError:
         raise NrrdError('Invalid NRRD magic line: %s' % (line,))
     return len(line)
 
@@ -287,14 +339,14 @@ def read_header(nrrdfile):
 
     it = iter(nrrdfile)
 
-    headerSize += _validate_magic_line(it.next())
+    headerSize += _validate_magic_line(_header_text(next(it)))
 
     header = { 'keyvaluepairs': {} }
     for raw_line in it:
         headerSize += len(raw_line)
 
         # Trailing whitespace ignored per the NRRD spec
-        line = raw_line.rstrip()
+        line = _header_text(raw_line).rstrip()
 
         # Comments start with '#', no leading whitespace allowed
         if line.startswith('#'):
@@ -306,7 +358,7 @@ def read_header(nrrdfile):
         # Handle the <key>:=<value> lines first since <value> may contain a
         # ': ' which messes up the <field>: <desc> parsing
         key_value = line.split(':=', 1)
-        if len(key_value) is 2:
+        if len(key_value) == 2:
             key, value = key_value
             # TODO: escape \\ and \n ??
             # value.replace(r'\\\\', r'\\').replace(r'\n', '\n')
@@ -315,7 +367,7 @@ def read_header(nrrdfile):
 
         # Handle the "<field>: <desc>" lines.
         field_desc = line.split(': ', 1)
-        if len(field_desc) is 2:
+        if len(field_desc) == 2:
             field, desc = field_desc
             if field not in _NRRD_FIELD_PARSERS:
                 raise NrrdError('Unexpected field in nrrd header: "%s".' % field)
@@ -333,14 +385,426 @@ def read_header(nrrdfile):
     return header
 
 
-def read(filename):
-    """Read a nrrd file and return a tuple (data, header)."""
+def read(filename, shared=False):
+    """Read a nrrd file and return a tuple (data, header).
+
+    With shared=True the data is read into a named shared memory block
+    instead and (data, header, handle) is returned, where handle is a
+    picklable SharedVolume. Other processes can call handle.attach() to
+    get the same (data, header) without copying, so a volume read by
+    one process can be used by many. See SharedVolume. Requires
+    Python 3.8 or later.
+    """
     with open(filename,'rb') as filehandle:
         header = read_header(filehandle)
+        if shared:
+            handle = SharedVolume._create(header)
+            out = handle._buffer()
+            try:
+                read_data(header, filehandle, filename, out=out)
+            except:
+                del out
+                handle.release()
+                raise
+            data, header = handle.attach()
+            return (data, header, handle)
         data = read_data(header, filehandle, filename)
         return (data, header)
 
 
+# Bytes at the start of a shared memory block holding its reference
+# count; the data follows
+_SHARED_PREFIX = 64
+
+
+class SharedVolume(object):
+    """Picklable handle to a volume read with read(filename, shared=True).
+
+    The data lives in a named multiprocessing.shared_memory block; the
+    handle only holds its name, the data type and shape, and the nrrd
+    header, so it is cheap to send to other processes. In each process,
+
+        data, header = handle.attach()
+
+    returns an ndarray backed by the shared block (writes are visible
+    to every process), and handle.release() detaches again. The block
+    is reference counted: every attach() (including the one done by
+    read()) counts, and the last release() removes it. Arrays already
+    obtained stay valid until they are garbage collected. The process
+    that called read() should keep running until the others have
+    attached, since the block is removed when it exits. Attachments are
+    per process: a handle inherited through fork must be attached in
+    the child too before its data is used there.
+    Can also be used as a context manager around attach/release.
+    """
+
+    def __init__(self, name, dtype, header):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.header = header
+        self._shm = None
+        # Process that attached _shm; a forked copy of the handle has
+        # _shm set without being counted
+        self._pid = None
+
+    @classmethod
+    def _create(cls, header):
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise NrrdError('Reading into shared memory needs Python 3.8 '
+                            'or later.')
+        dtype = _determine_dtype(header)
+        nbytes = dtype.itemsize * int(np.prod(header['sizes']))
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=_SHARED_PREFIX + max(nbytes, 1))
+        handle = cls(shm.name, dtype, header)
+        handle._shm = shm
+        handle._pid = os.getpid()
+        np.ndarray((1,), np.int64, shm.buf)[0] = 1
+        return handle
+
+    @property
+    def shape(self):
+        return tuple(self.header['sizes'])
+
+    def __getstate__(self):
+        return {'name': self.name, 'dtype': self.dtype.str,
+                'header': self.header}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['dtype'], state['header'])
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _buffer(self):
+        """The data as a flat array, sharing memory with the block."""
+        count = int(np.prod(self.shape))
+        return np.asarray(_SharedArrayBase(self._shm, (count,), self.dtype))
+
+    def _refcount(self, change):
+        """Add change to the reference count, returning the new count."""
+        with _shared_lock(self.name):
+            count = np.ndarray((1,), np.int64, self._shm.buf)
+            count[0] += change
+            return int(count[0])
+
+    def _attached(self):
+        return self._shm is not None and self._pid == os.getpid()
+
+    def attach(self):
+        """Map the shared data into this process; returns (data, header)."""
+        if not self._attached():
+            from multiprocessing import shared_memory
+            try:
+                self._shm = shared_memory.SharedMemory(self.name, track=False)
+            except TypeError:
+                # Before python 3.13 attaching registers the block with
+                # this process's resource tracker, which may unlink it
+                # when this process exits; only its creator should.
+                from multiprocessing import resource_tracker
+                register = resource_tracker.register
+                resource_tracker.register = lambda name, rtype: None
+                try:
+                    self._shm = shared_memory.SharedMemory(self.name)
+                finally:
+                    resource_tracker.register = register
+            self._pid = os.getpid()
+            self._refcount(1)
+        data = np.reshape(self._buffer(), self.shape, order='F')
+        return (data, self.header)
+
+    def release(self):
+        """Detach from the shared data, freeing it if nobody else uses it."""
+        if not self._attached():
+            # Never attached in this process (e.g. inherited via fork)
+            self._shm = None
+            return
+        # Not closed here: arrays handed out keep the block mapped
+        # until they are gone, see _SharedArrayBase
+        remaining = self._refcount(-1)
+        if remaining <= 0:
+            try:
+                self._shm.unlink()
+            except OSError:
+                # Already removed
+                pass
+            _remove_shared_lock(self.name)
+        self._shm = None
+
+
+class _SharedArrayBase(object):
+    """Base object for arrays in a shared memory block, keeping the
+    block mapped for as long as any of them is alive (numpy does not
+    hold on to the buffer of shm.buf itself)."""
+
+    def __init__(self, shm, shape, dtype):
+        view = np.ndarray(shape, dtype, shm.buf, offset=_SHARED_PREFIX)
+        self.__array_interface__ = view.__array_interface__
+        self.shm = shm
+
+
+def _shared_lock_filename(name):
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), 'pynrrd-%s.lock' % name)
+
+
+class _shared_lock(object):
+    """Cross-process lock guarding a shared block's reference count.
+    Without fcntl (Windows) the OS frees blocks itself and no lock is
+    taken."""
+
+    def __init__(self, name):
+        self.filename = _shared_lock_filename(name)
+        self.lockfile = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self.lockfile = open(self.filename, 'a')
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.lockfile is not None:
+            import fcntl
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+            self.lockfile.close()
+
+
+def _remove_shared_lock(name):
+    try:
+        os.remove(_shared_lock_filename(name))
+    except OSError:
+        pass
+
+
+def _gzip_index_filename(datafilename):
+    return datafilename + '.gzidx'
+
+
+def _load_gzip_index(datafilename, compressedsize):
+    """The member table of a gzip data file, or None if there is no
+    (up to date) index for it."""
+    indexfilename = _gzip_index_filename(datafilename)
+    if not os.path.exists(indexfilename):
+        return None
+    with open(indexfilename) as indexfile:
+        index = json.load(indexfile)
+    if index.get('compressed size') != compressedsize:
+        return None
+    return index
+
+
+def _save_gzip_index(datafilename, members, compressedsize):
+    """Write the sidecar index; members is a list of (uncompressed
+    offset, compressed offset) pairs, relative to the start of the data."""
+    index = {'version': 1, 'compressed size': compressedsize,
+             'members': [list(member) for member in members]}
+    try:
+        with open(_gzip_index_filename(datafilename), 'w') as indexfile:
+            json.dump(index, indexfile)
+    except IOError:
+        # e.g. a read-only archive; the index is only an optimization
+        pass
+    return index
+
+
+def _extract_runs(out, uoffset, runs, r, pieces):
+    """Append the parts of the decompressed chunk `out`, which starts at
+    uncompressed offset uoffset, that fall in runs[r:] to pieces.
+    Returns the index of the first run not completed by this chunk."""
+    end = uoffset + len(out)
+    while r < len(runs) and runs[r][0] < end:
+        lo, hi = runs[r]
+        pieces.append(out[max(lo - uoffset, 0):min(hi, end) - uoffset])
+        if hi > end:
+            break
+        r += 1
+    return r
+
+
+def _read_gzip_runs(datafilehandle, datafilename, runs):
+    """Decompressed bytes of the sorted, disjoint (lo, hi) byte ranges
+    `runs` of the gzip data starting at the current position of
+    datafilehandle, concatenated, decoding as little as possible."""
+    datastart = datafilehandle.tell()
+    datafilehandle.seek(0, 2)
+    compressedsize = datafilehandle.tell() - datastart
+    pieces = []
+    if not runs:
+        return b''
+    index = _load_gzip_index(datafilename, compressedsize)
+    if index is not None:
+        # Decode just the members that overlap a run
+        members = index['members'] + [[None, compressedsize]]
+        r = 0
+        for (ustart, cstart), (uend, cend) in zip(members[:-1], members[1:]):
+            while r < len(runs) and runs[r][1] <= ustart:
+                r += 1
+            if r == len(runs):
+                break
+            if uend is not None and runs[r][0] >= uend:
+                continue
+            # Inflate the member only up to the end of the last run in it
+            last = r
+            while (last + 1 < len(runs) and
+                   (uend is None or runs[last + 1][0] < uend)):
+                last += 1
+            datafilehandle.seek(datastart + cstart)
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out = decompressor.decompress(datafilehandle.read(cend - cstart),
+                                          runs[last][1] - ustart)
+            _extract_runs(out, ustart, runs, r, pieces)
+        return b''.join(pieces)
+
+    # No index: decode from the start, member by member, recording where
+    # the members are. Stop after the last run unless the stream turns
+    # out to consist of several members, in which case an index is built
+    # for next time.
+    datafilehandle.seek(datastart)
+    hi = runs[-1][1]
+    members = [(0, 0)]
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    uoffset = 0
+    coffset = 0
+    r = 0
+    while True:
+        if uoffset >= hi and len(members) == 1:
+            break
+        block = datafilehandle.read(1024*1024)
+        if not block:
+            break
+        while block:
+            out = decompressor.decompress(block)
+            r = _extract_runs(out, uoffset, runs, r, pieces)
+            uoffset += len(out)
+            coffset += len(block) - len(decompressor.unused_data)
+            block = decompressor.unused_data
+            if decompressor.unused_data or _gzip_member_done(decompressor):
+                # Another member follows (possibly in the next block)
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                members.append((uoffset, coffset))
+    if coffset == compressedsize:
+        if members[-1][1] == compressedsize:
+            members.pop()
+        # A single member can only be read from the start anyway
+        if len(members) > 1:
+            _save_gzip_index(datafilename, members, compressedsize)
+    return b''.join(pieces)
+
+
+def _gzip_member_done(decompressor):
+    """True if a zlib decompressor has seen the end of its gzip member."""
+    return getattr(decompressor, 'eof', False)
+
+
+def _subvolume_runs(sizes, bounds, itemsize):
+    """The byte ranges (lo, hi) of Fortran-ordered data with the given
+    sizes holding the sub-volume with per-axis (start, stop) bounds, in
+    file order. Axes up to the first partially read one are contiguous,
+    so each run covers all of them."""
+    if any(stop <= start for start, stop in bounds):
+        return []
+    strides = [itemsize]
+    for size in sizes[:-1]:
+        strides.append(strides[-1] * size)
+    k = 0
+    while k < len(sizes) - 1 and bounds[k] == (0, sizes[k]):
+        k += 1
+    runbytes = (bounds[k][1] - bounds[k][0]) * strides[k]
+    first = sum(start * stride for (start, stop), stride in zip(bounds, strides))
+    offsets = [first]
+    # Outer axes, fastest first, so the offsets come out sorted
+    for axis in range(k + 1, len(sizes)):
+        start, stop = bounds[axis]
+        offsets = [offset + i * strides[axis]
+                   for i in range(stop - start) for offset in offsets]
+    return [(offset, offset + runbytes) for offset in offsets]
+
+
+def read_subvolume(filename, ranges):
+    """Read a box out of a nrrd file, e.g. one velocity channel.
+
+    `ranges` has one entry per axis, either None for the whole axis or
+    a (start, stop) pair, so read_subvolume(f, [None, (10, 11), None])
+    gives data[:, 10:11, :]. Only the parts of the file holding the box
+    are read: raw data is seeked into, and gzip data written with
+    write(..., gzip_member_bytes=N) is decoded only for the gzip members
+    holding some of it (see write()). Members hold whole runs of the
+    file's fastest axes, so a box that is thin along a slow axis touches
+    few members, but one that is thin along a fast axis (say one
+    velocity channel of an (RA, Vel, Dec) cube) only skips members if
+    they are smaller than the gap between its rows (an RA x Vel plane).
+    Other gzip files are decoded from the start up to the end of the
+    box; if they turn out to consist of several members an index is
+    saved next to them, so later reads are fast. Other encodings are
+    read in full. Returns (data, header).
+    """
+    with open(filename,'rb') as filehandle:
+        header = read_header(filehandle)
+        sizes = list(header['sizes'])
+        if len(ranges) != len(sizes):
+            raise NrrdError('Need one range per axis (%d), got %d.' %
+                            (len(sizes), len(ranges)))
+        bounds = []
+        for r, size in zip(ranges, sizes):
+            if r is None:
+                r = (0, size)
+            start, stop, step = slice(*r).indices(size)
+            bounds.append((start, max(start, stop)))
+        box = tuple(slice(start, stop) for start, stop in bounds)
+        encoding = header['encoding']
+        if encoding not in ('raw', 'gzip', 'gz'):
+            data = read_data(header, filehandle, filename)
+            return (data[box], header)
+        dtype = _determine_dtype(header)
+        runs = _subvolume_runs(sizes, bounds, dtype.itemsize)
+        datafilehandle, datafilename = _open_data_file(header, filehandle,
+                                                       filename)
+        lineskip = header.get('lineskip', header.get('line skip', 0))
+        for _ in range(lineskip):
+            datafilehandle.readline()
+        if encoding == 'raw':
+            byteskip = header.get('byteskip', header.get('byte skip', 0))
+            if byteskip == -1:
+                totalbytes = dtype.itemsize * int(np.prod(sizes))
+                datafilehandle.seek(-totalbytes, 2)
+            else:
+                datafilehandle.seek(byteskip, 1)
+            datastart = datafilehandle.tell()
+            pieces = []
+            for lo, hi in runs:
+                datafilehandle.seek(datastart + lo)
+                pieces.append(datafilehandle.read(hi - lo))
+            rawdata = b''.join(pieces)
+        else:
+            rawdata = _read_gzip_runs(datafilehandle, datafilename, runs)
+        if datafilehandle is not filehandle:
+            datafilehandle.close()
+    data = np.frombuffer(rawdata, dtype).copy()
+    data = np.reshape(data, tuple(stop - start for start, stop in bounds),
+                      order='F')
+    return (data, header)
+
+
+def read_slab(filename, start, stop):
+    """Read data[..., start:stop] of a nrrd file, along its last axis.
+
+    Only the part of the file holding that slab is read, see
+    read_subvolume(). Returns (data, header).
+    """
+    with open(filename,'rb') as filehandle:
+        ndim = len(read_header(filehandle)['sizes'])
+    return read_subvolume(filename, [None]*(ndim - 1) + [(start, stop)])
+
+
 def _format_nrrd_list(fieldValue) :
     return ' '.join([str(x) for x in fieldValue])
 
@@ -394,24 +858,281 @@ _NRRD_FIELD_FORMATTERS = {
 }
 
 
-def _write_data(data, filehandle, options):
+# Approximate size of the slabs that data is serialized in when writing
+_WRITE_SLAB_BYTES = 64*1024*1024
+
+
+def _data_slabs(data):
+    """Yield the data in nrrd (Fortran) byte order, one slab at a time.
+
+    Slabs are cut along the last axis, which is the slowest one in
+    Fortran order, so concatenating them gives the full data. `data`
+    only needs shape, ndim, dtype and data[..., start:stop] slicing,
+    so lazily-read arrays are only loaded a slab at a time.
+    """
+    if data.ndim == 0:
+        yield np.asarray(data).tobytes()
+        return
+    slabbytes = data.dtype.itemsize * int(np.prod(data.shape[:-1]))
+    step = max(1, _WRITE_SLAB_BYTES // max(1, slabbytes))
+    for start in range(0, data.shape[-1], step):
+        slab = np.asarray(data[..., start:start+step])
+        yield slab.tobytes(order = 'F')
+
+
+class _BZ2Writer(object):
+    """Minimal write-only file object compressing into another file."""
+    def __init__(self, fileobj, compresslevel=9):
+        self.fileobj = fileobj
+        self.compressor = bz2.BZ2Compressor(compresslevel)
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+
+def _rechunk(blocks, size):
+    """Regroup an iterable of byte strings into pieces of `size` bytes."""
+    pending = []
+    npending = 0
+    for block in blocks:
+        start = 0
+        while start < len(block):
+            piece = block[start:start + size - npending]
+            start += len(piece)
+            pending.append(piece)
+            npending += len(piece)
+            if npending == size:
+                yield b''.join(pending)
+                pending = []
+                npending = 0
+    if pending:
+        yield b''.join(pending)
+
+
+def _write_gzip_members(data, filehandle, compresslevel, memberbytes):
+    """Write the data as independent gzip members of `memberbytes`
+    uncompressed bytes each, returning the member table for the index."""
+    datastart = filehandle.tell()
+    members = []
+    uoffset = 0
+    for rawdata in _rechunk(_data_slabs(data), memberbytes):
+        members.append((uoffset, filehandle.tell() - datastart))
+        fileobj = gzip.GzipFile(fileobj = filehandle, mode = 'wb',
+                                compresslevel = compresslevel)
+        fileobj.write(rawdata)
+        fileobj.close()
+        uoffset += len(rawdata)
+    return members, filehandle.tell() - datastart
+
+
+def _write_data(data, filehandle, options, compresslevel=9):
     # Now write data directly
-    rawdata = data.tostring(order = 'F')
     if options['encoding'] == 'raw':
-        filehandle.write(rawdata)
+        fileobj = filehandle
     elif options['encoding'] == 'gzip':
-        gzfileobj = gzip.GzipFile(fileobj = filehandle)
-        gzfileobj.write(rawdata)
-        gzfileobj.close()
+        fileobj = gzip.GzipFile(fileobj = filehandle, mode = 'wb',
+                                compresslevel = compresslevel)
     elif options['encoding'] == 'bz2':
-        bz2fileobj = bz2.BZ2File(fileobj = filehandle)
-        bz2fileobj.write(rawdata)
-        bz2fileobj.close()
+        fileobj = _BZ2Writer(filehandle, compresslevel)
     else:
         raise NrrdError('Unsupported encoding: "%s"' % options['encoding'])
+    for rawdata in _data_slabs(data):
+        fileobj.write(rawdata)
+    if fileobj is not filehandle:
+        fileobj.close()
+
+
+def _write_header(filehandle, options):
+    """Write the magic line, comments, fields and key/value pairs."""
+    filehandle.write(_header_bytes('NRRD0004\n'))
+    filehandle.write(_header_bytes('# This NRRD file was generated by pynrrd\n'))
+    filehandle.write(_header_bytes('# on ' +
+                     datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') +
+                     '(GMT).\n'))
+    filehandle.write(_header_bytes('# Complete NRRD file format specification at:\n'));
+    filehandle.write(_header_bytes('# http://teem.sourceforge.net/nrrd/format.html\n'));
+
+    # Write the fields in order, this ignores fields not in _NRRD_FIELD_ORDER
+    for field in _NRRD_FIELD_ORDER:
+        if field in options:
+            outline = (field + ': ' +
+                       _NRRD_FIELD_FORMATTERS[field](options[field]) +
+                       '\n')
+            filehandle.write(_header_bytes(outline))
+    for (k,v) in options.get('keyvaluepairs', {}).items():
+        outline = k + ':=' + v + '\n'
+        filehandle.write(_header_bytes(outline))
+
+
+def _infer_fields(data, options):
+    """Infer a number of fields from the data and ignore values
+    in the options dictionary."""
+    options['type'] = _TYPEMAP_NUMPY2NRRD[data.dtype.str[1:]]
+    if data.dtype.itemsize > 1:
+        options['endian'] = _NUMPY2NRRD_ENDIAN_MAP[data.dtype.str[:1]]
+    options['dimension'] = data.ndim
+    options['sizes'] = list(data.shape)
+
+
+def write_header(filename, data, datafile, options={}, byteskip=0):
+    """Write a detached header (.nhdr) for data that already exists on disk.
+
+    `data` describes the raw, Fortran-ordered samples found `byteskip`
+    bytes into `datafile` (e.g. a np.memmap of them); type, endian and
+    sizes are inferred from it as in write(), but nothing is written
+    except the header. A relative `datafile` is taken relative to the
+    directory of the header. The encoding defaults to 'raw'.
+
+    """
+    _infer_fields(data, options)
+    if 'encoding' not in options:
+        options['encoding'] = 'raw'
+    with open(filename,'wb') as filehandle:
+        _write_header(filehandle, options)
+        filehandle.write(_header_bytes('data file: ' + datafile + '\n'))
+        filehandle.write(_header_bytes('byte skip: %d\n' % byteskip))
+
+
+def _padding_line(size):
+    """A comment line of exactly `size` bytes reserving header space."""
+    if size >= len(_HEADER_PADDING_COMMENT) + 1:
+        return (_HEADER_PADDING_COMMENT +
+                ' '*(size - len(_HEADER_PADDING_COMMENT) - 1) + '\n')
+    return '#' + ' '*(size - 2) + '\n'
+
+
+# Candidate (encoding, compresslevel) pairs for encoding 'auto'
+_AUTO_ENCODINGS = [('raw', None), ('gzip', 1), ('gzip', 6), ('gzip', 9),
+                   ('bz2', 9)]
+
+# Default targets for encoding 'auto', see choose_encoding()
+_AUTO_TARGETS = {'min_saving': 0.1, 'min_write_mbps': 20.}
+
+# Number and total size of the slabs sampled by choose_encoding()
+_AUTO_SAMPLES = 4
+_AUTO_SAMPLE_BYTES = 4*1024*1024
+
+
+def _sample_slabs(data):
+    """A few evenly spaced slabs of data, as nrrd-ordered byte strings."""
+    if data.ndim == 0:
+        return [np.asarray(data).tobytes()]
+    nslabs = data.shape[-1]
+    slabbytes = data.dtype.itemsize * int(np.prod(data.shape[:-1]))
+    maxbytes = _AUTO_SAMPLE_BYTES // _AUTO_SAMPLES
+    step = max(1, min(nslabs // _AUTO_SAMPLES, maxbytes // max(1, slabbytes)))
+    starts = np.linspace(0, max(0, nslabs - step), _AUTO_SAMPLES)
+    samples = []
+    for start in sorted(set(int(x) for x in starts)):
+        slab = np.asarray(data[..., start:start+step])
+        samples.append(slab.tobytes(order = 'F')[:maxbytes])
+    return samples
+
+
+def _codec_functions(encoding, compresslevel):
+    """(compress, decompress) functions on byte strings for an encoding."""
+    if encoding == 'gzip':
+        return (lambda raw: zlib.compress(raw, compresslevel),
+                zlib.decompress)
+    elif encoding == 'bz2':
+        return (lambda raw: bz2.compress(raw, compresslevel),
+                bz2.decompress)
+    return (lambda raw: raw, lambda raw: raw)
+
+
+def choose_encoding(data, targets=None):
+    """Pick an encoding for the data by compressing a few sampled slabs.
+
+    Every candidate encoding (raw, gzip at levels 1, 6 and 9, bzip2) is
+    tried on the samples, measuring its size ratio and write (compress)
+    and read (decompress) speed. The targets dictionary may contain
+
+        max_size        estimated output size in bytes
+        min_saving      fraction of the raw size that must be saved
+        min_write_mbps  write speed in MB/s
+        min_read_mbps   read speed in MB/s
+
+    and is merged over the defaults `{'min_saving': 0.1,
+    'min_write_mbps': 20.}` (set a target to 0 to disable it). Of the
+    candidates meeting all targets the one giving the smallest file
+    wins. If none does but some meet the speed and saving targets (so
+    only max_size is missed), the smallest of those is used. Otherwise
+    compressing isn't worth it and 'raw' is used.
 
+    Returns (encoding, compresslevel, report, met), where report is a
+    list of (encoding, compresslevel, ratio, write_mbps, read_mbps)
+    tuples and met tells whether the choice meets all targets.
 
-def write(filename, data, options={}, separate_header=False):
+    """
+    targets = dict(_AUTO_TARGETS, **(targets or {}))
+    unknown = set(targets) - set(['max_size', 'min_saving',
+                                  'min_write_mbps', 'min_read_mbps'])
+    if unknown:
+        raise NrrdError('Unknown encoding targets: %s' % ', '.join(unknown))
+    samples = _sample_slabs(data)
+    samplebytes = float(sum(len(sample) for sample in samples))
+    totalbytes = data.dtype.itemsize * int(np.prod(data.shape))
+
+    report = []
+    for encoding, compresslevel in _AUTO_ENCODINGS:
+        if encoding == 'raw':
+            report.append((encoding, compresslevel, 1., float('inf'),
+                           float('inf')))
+            continue
+        compress, decompress = _codec_functions(encoding, compresslevel)
+        compressed = []
+        start = time.time()
+        for sample in samples:
+            compressed.append(compress(sample))
+        writetime = time.time() - start
+        start = time.time()
+        for block in compressed:
+            decompress(block)
+        readtime = time.time() - start
+        ratio = sum(len(block) for block in compressed) / max(samplebytes, 1.)
+        report.append((encoding, compresslevel, ratio,
+                       samplebytes / 1e6 / max(writetime, 1e-9),
+                       samplebytes / 1e6 / max(readtime, 1e-9)))
+
+    def fast_enough(candidate):
+        return (candidate[3] >= targets.get('min_write_mbps', 0) and
+                candidate[4] >= targets.get('min_read_mbps', 0))
+
+    def saves_enough(candidate):
+        return 1 - candidate[2] >= targets.get('min_saving', 0)
+
+    def small_enough(candidate):
+        return (candidate[2] * totalbytes <=
+                targets.get('max_size', float('inf')) and
+                saves_enough(candidate))
+
+    for candidates in ([c for c in report if fast_enough(c) and small_enough(c)],
+                       [c for c in report if fast_enough(c) and saves_enough(c)],
+                       [report[0]]):
+        if candidates:
+            # Smallest file; among equals, the fastest to write
+            best = min(candidates, key=lambda c: (c[2], -c[3]))
+            break
+    met = fast_enough(best) and small_enough(best)
+    return (best[0], best[1], report, met)
+
+
+def _format_encoding_report(report):
+    """One-line summary of choose_encoding() measurements."""
+    entries = []
+    for encoding, compresslevel, ratio, write_mbps, read_mbps in report:
+        if encoding == 'raw':
+            continue
+        entries.append('%s:%d ratio %.3f write %.0f MB/s read %.0f MB/s' %
+                       (encoding, compresslevel, ratio, write_mbps, read_mbps))
+    return '; '.join(entries)
+
+
+def write(filename, data, options={}, separate_header=False, header_padding=0,
+          compresslevel=9, encoding_targets=None, gzip_member_bytes=None):
     """Write the numpy data to a nrrd file. The nrrd header values to use are
     inferred from from the data. Additional options can be passed in the
     options dictionary. See the read() function for the structure of this
@@ -420,18 +1141,46 @@ def write(filename, data, options={}, separate_header=False):
     To set data samplings, use e.g. `options['spacings'] = [s1, s2, s3]` for
     3d data with sampling deltas `s1`, `s2`, and `s3` in each dimension.
 
+    The data is written a slab at a time, so besides an ndarray it can be
+    any array-like with shape, ndim, dtype and data[..., start:stop]
+    slicing (such as a lazily-read cube).
+
+    header_padding reserves that many bytes in the header as a comment
+    line, so that update_header() can later change fields in place
+    without rewriting the data.
+
+    compresslevel (1-9) applies to the 'gzip' and 'bz2' encodings. With
+    `options['encoding'] = 'auto'` the encoding and level are chosen by
+    choose_encoding(data, encoding_targets), and the choice and the
+    measurements behind it are recorded in the key/value pairs (marked
+    "targets not met" if no candidate met them all).
+
+    gzip_member_bytes makes gzip data a series of independent gzip members
+    of that many uncompressed bytes each (still a valid gzip stream), and
+    writes their offsets to a sidecar index (<data file>.gzidx). Then
+    read_slab() only has to decode the members covering the slab read.
+
     """
-    # Infer a number of fields from the ndarray and ignore values
-    # in the options dictionary.
-    options['type'] = _TYPEMAP_NUMPY2NRRD[data.dtype.str[1:]]
-    if data.dtype.itemsize > 1:
-        options['endian'] = _NUMPY2NRRD_ENDIAN_MAP[data.dtype.str[:1]]
-    options['dimension'] = data.ndim
-    options['sizes'] = list(data.shape)
+    _infer_fields(data, options)
 
     # The default encoding is 'gzip'
     if 'encoding' not in options:
         options['encoding'] = 'gzip'
+    elif options['encoding'] == 'auto':
+        encoding, compresslevel, report, met = choose_encoding(
+            data, encoding_targets)
+        options['encoding'] = encoding
+        keyvaluepairs = dict(options.get('keyvaluepairs', {}))
+        if encoding == 'raw':
+            keyvaluepairs['auto encoding'] = 'raw'
+        else:
+            keyvaluepairs['auto encoding'] = '%s:%d' % (encoding,
+                                                        compresslevel)
+        if not met:
+            keyvaluepairs['auto encoding'] += ' (targets not met)'
+        keyvaluepairs['auto encoding samples'] = \
+            _format_encoding_report(report)
+        options['keyvaluepairs'] = keyvaluepairs
 
     # A bit of magic in handling options here.
     # If *.nhdr filename provided, this overrides `separate_header=False`
@@ -449,42 +1198,150 @@ def write(filename, data, options={}, separate_header=False):
         datafilename = filename
 
     with open(filename,'wb') as filehandle:
-        filehandle.write('NRRD0004\n')
-        filehandle.write('# This NRRD file was generated by pynrrd\n')
-        filehandle.write('# on ' +
-                         datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') +
-                         '(GMT).\n')
-        filehandle.write('# Complete NRRD file format specification at:\n');
-        filehandle.write('# http://teem.sourceforge.net/nrrd/format.html\n');
-
-        # Write the fields in order, this ignores fields not in _NRRD_FIELD_ORDER
-        for field in _NRRD_FIELD_ORDER:
-            if options.has_key(field):
-                outline = (field + ': ' +
-                           _NRRD_FIELD_FORMATTERS[field](options[field]) +
-                           '\n')
-                filehandle.write(outline)
-        for (k,v) in options.get('keyvaluepairs', {}).items():
-            outline = k + ':=' + v + '\n'
-            filehandle.write(outline)
+        _write_header(filehandle, options)
+        if header_padding > 0:
+            filehandle.write(_header_bytes(_padding_line(max(header_padding, 2))))
 
         if separate_header:
             # Write line skip & relative file location info to header
             outline = ('data file: ' + os.path.basename(datafilename) + '\n')
-            filehandle.write(outline)
-            filehandle.write('line skip: 0')
+            filehandle.write(_header_bytes(outline))
+            filehandle.write(_header_bytes('line skip: 0'))
 
         # Write the closing extra newline
-        filehandle.write('\n')
+        filehandle.write(_header_bytes('\n'))
 
         # If a single file desired, write data
         if not separate_header:
-            _write_data(data, filehandle, options)
+            gzipindex = _write_data_indexed(data, filehandle, options,
+                            compresslevel, gzip_member_bytes)
 
     # If separate header desired, write data to different file
     if separate_header:
         with open(datafilename, 'wb') as datafilehandle:
-            _write_data(data, datafilehandle, options)
+            gzipindex = _write_data_indexed(data, datafilehandle, options,
+                            compresslevel, gzip_member_bytes)
+
+    # Never leave an index describing an older version of the data
+    indexfilename = _gzip_index_filename(datafilename)
+    if gzipindex is not None:
+        _save_gzip_index(datafilename, *gzipindex)
+    elif os.path.exists(indexfilename):
+        os.remove(indexfilename)
+
+
+def _write_data_indexed(data, filehandle, options, compresslevel,
+                        gzip_member_bytes):
+    """Write the data, as gzip members if requested; returns the
+    (members, compressed size) for the index, or None."""
+    if options['encoding'] == 'gzip' and gzip_member_bytes:
+        return _write_gzip_members(data, filehandle, compresslevel,
+                                   gzip_member_bytes)
+    _write_data(data, filehandle, options, compresslevel)
+    return None
+
+def _read_header_lines(filehandle):
+    """Return the raw header lines, including the closing blank line."""
+    lines = []
+    for line in iter(filehandle.readline, b''):
+        line = _header_text(line)
+        lines.append(line)
+        if line.strip() == '':
+            break
+    return lines
+
+
+def update_header(filename, **fields):
+    """Change header fields of an existing nrrd file without touching the data.
+
+    Fields are given as keyword arguments, with spaces in field names
+    written as underscores, e.g.
+
+    >>> update_header('cube.nrrd', space_origin=[0, 0, 0])  # doctest: +SKIP
+
+    keyvaluepairs=dict(...) adds or replaces <key>:=<value> pairs.
+    Fields describing the data layout (type, sizes, encoding, ...) can't
+    be changed this way.
+
+    Detached headers (.nhdr) are simply rewritten. For attached headers
+    the new header must fit in the space of the old one, using the
+    padding reserved by write(..., header_padding=N) (or any other blank
+    comment lines) to absorb size changes; the file is then updated in
+    place. If it does not fit, the whole file is rewritten.
+
+    """
+    keyvaluepairs = dict(fields.pop('keyvaluepairs', {}))
+    updates = {}
+    for name, value in fields.items():
+        field = name.replace('_', ' ')
+        if field not in _NRRD_FIELD_FORMATTERS:
+            raise NrrdError('Unknown nrrd header field: "%s".' % field)
+        if field in _NRRD_LAYOUT_FIELDS:
+            raise NrrdError('Field "%s" describes the data layout and can not '
+                            'be updated.' % field)
+        updates[field] = (field + ': ' +
+                          _NRRD_FIELD_FORMATTERS[field](value) + '\n')
+
+    with open(filename, 'rb') as filehandle:
+        oldlines = _read_header_lines(filehandle)
+    headersize = sum(len(line) for line in oldlines)
+    _validate_magic_line(oldlines[0].rstrip())
+    closing = ''
+    if len(oldlines) > 1 and oldlines[-1].strip() == '':
+        closing = oldlines.pop()
+
+    # Replace fields where they are, and note where the padding was
+    detached = filename[-5:] == '.nhdr'
+    lines = [oldlines[0]]
+    padding_at = None
+    padding = ''
+    for line in oldlines[1:]:
+        if line.startswith('#'):
+            if line.startswith(_HEADER_PADDING_COMMENT) or line.strip() == '#':
+                if padding_at is None:
+                    padding_at = len(lines)
+                padding += line
+                continue
+        elif ':=' in line:
+            key = line.split(':=', 1)[0]
+            if key in keyvaluepairs:
+                line = key + ':=' + keyvaluepairs.pop(key) + '\n'
+        else:
+            field = line.split(': ', 1)[0]
+            if field in ('datafile', 'data file'):
+                detached = True
+            if field in updates:
+                line = updates.pop(field)
+        lines.append(line)
+    # Anything left over is new
+    lines.extend(updates[field] for field in _NRRD_FIELD_ORDER
+                 if field in updates)
+    lines.extend(k + ':=' + v + '\n' for (k, v) in keyvaluepairs.items())
+
+    slack = headersize - sum(len(line) for line in lines) - len(closing)
+    if padding_at is None:
+        padding_at = len(lines)
+    if detached:
+        # Only the header file changes, so its size doesn't matter
+        lines.insert(padding_at, padding)
+        with open(filename, 'wb') as filehandle:
+            filehandle.write(_header_bytes(''.join(lines) + closing))
+    elif slack == 0 or slack >= 2:
+        if slack > 0:
+            lines.insert(padding_at, _padding_line(slack))
+        with open(filename, 'r+b') as filehandle:
+            filehandle.write(_header_bytes(''.join(lines) + closing))
+    else:
+        # Doesn't fit: rewrite the whole file, with fresh padding
+        lines.insert(padding_at, _padding_line(_DEFAULT_HEADER_PADDING))
+        tmpfilename = filename + '.tmp'
+        with open(filename, 'rb') as filehandle:
+            filehandle.seek(headersize)
+            with open(tmpfilename, 'wb') as tmpfilehandle:
+                tmpfilehandle.write(_header_bytes(''.join(lines) + closing))
+                shutil.copyfileobj(filehandle, tmpfilehandle)
+        os.rename(tmpfilename, filename)
+
 
 if __name__ == "__main__":
     import doctest
@@ -1,6 +1,4 @@
 import numpy as n
-import scipy.interpolate
-import scipy.ndimage
  
 def congrid(a, newdims, method='linear', centre=False, minusone=False):
      '''Arbitrary resampling of source array to new dimension sizes.
@@ -28,6 +26,10 @@ def congrid(a, newdims, method='linear', centre=False, minusone=False):
      True - inarray is resampled by(i-1)/(x-1) * (j-1)/(y-1)
      This prevents extrapolation one element beyond bounds of input array.
      '''
+     # scipy is only needed here, so don't make importers pay for it
+     import scipy.interpolate
+     import scipy.ndimage
+
      if not a.dtype in [n.float64, n.float32]:
          a = n.cast[float](a)
  
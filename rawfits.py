@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+rawfits.py
+
+A minimal reader for plain, uncompressed FITS primary HDUs that
+bypasses astropy. The header is parsed directly from the 2880-byte
+blocks and the data is exposed as a read-only np.memmap in the
+file's (big-endian) type. BSCALE/BZERO and byte swapping are applied
+lazily, only to the slabs that are actually requested.
+
+Only simple images qualify: SIMPLE = T, an integer or IEEE BITPIX,
+no random groups and no BLANK keyword. Anything else should be read
+with astropy instead; see qualifies().
+
+Example Use
+-----------
+import rawfits
+
+if rawfits.qualifies("ngc1333_co.fits"):
+    cube = rawfits.PrimaryCube("ngc1333_co.fits")
+    plane = cube[10]       # scaled, native-endian ndarray
+"""
+
+import numpy as np
+import os.path
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+_BITPIX2NUMPY = {
+    8: '>u1',
+    16: '>i2',
+    32: '>i4',
+    64: '>i8',
+    -32: '>f4',
+    -64: '>f8'
+}
+
+# BZERO that marks integer data as unsigned (or, for bytes, signed),
+# and the type astropy returns it as
+_BITPIX2UNSIGNED = {
+    8: (-128, 'i1'),
+    16: (2**15, 'u2'),
+    32: (2**31, 'u4'),
+    64: (2**63, 'u8')
+}
+
+# Type of the scaled data, following astropy's choice
+_BITPIX2FLOAT = {
+    8: 'f4',
+    16: 'f4',
+    32: 'f8',
+    64: 'f8',
+    -32: 'f4',
+    -64: 'f8'
+}
+
+class RawFitsError(Exception):
+    """Exceptions for the raw FITS reader."""
+    pass
+
+def _parse_value(value):
+    """Convert the value part of a header card to a python value."""
+    value = value.strip()
+    if value.startswith("'"):
+        # Strings are quoted, with '' standing for a literal quote
+        end = 1
+        while True:
+            end = value.find("'", end)
+            if end == -1:
+                raise RawFitsError('Unterminated string in header: %s' % value)
+            if value[end+1:end+2] == "'":
+                end += 2
+                continue
+            break
+        return value[1:end].replace("''", "'").rstrip()
+    # Strip any trailing comment
+    value = value.split('/', 1)[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    if value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        return value
+
+def read_header(fitsfile):
+    """Read the primary header of an open FITS file.
+
+    Returns a tuple (header, data_offset), where header is a dict of
+    keyword -> value and data_offset is the byte offset of the data.
+    Commentary cards (COMMENT, HISTORY, blank) are skipped.
+    """
+    header = {}
+    nblocks = 0
+    while True:
+        block = fitsfile.read(BLOCK_SIZE)
+        if len(block) != BLOCK_SIZE:
+            raise RawFitsError('Truncated FITS header (no END card).')
+        if not isinstance(block, str):
+            block = block.decode('ascii')
+        nblocks += 1
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i+CARD_SIZE]
+            keyword = card[:8].rstrip()
+            if keyword == 'END':
+                return (header, nblocks*BLOCK_SIZE)
+            if card[8:10] != '= ':
+                continue
+            header[keyword] = _parse_value(card[10:])
+
+def qualifies(filename):
+    """True if filename is a primary HDU this module can read."""
+    try:
+        with open(filename, 'rb') as fitsfile:
+            header, offset = read_header(fitsfile)
+    except (IOError, RawFitsError):
+        return False
+    if _check_header(header) is not None:
+        return False
+    nbytes = abs(header['BITPIX'])//8
+    for n in range(1, header['NAXIS']+1):
+        nbytes *= header['NAXIS%d' % n]
+    return os.path.getsize(filename) >= offset + nbytes
+
+def _check_header(header):
+    """Return the reason a header can't be read raw, or None if it can."""
+    if header.get('SIMPLE') is not True:
+        return 'not a standard FITS file (SIMPLE != T)'
+    if header.get('BITPIX') not in _BITPIX2NUMPY:
+        return 'unsupported BITPIX: %s' % header.get('BITPIX')
+    naxis = header.get('NAXIS', 0)
+    if naxis < 1:
+        return 'no data in primary HDU'
+    for n in range(1, naxis+1):
+        if 'NAXIS%d' % n not in header:
+            return 'missing NAXIS%d' % n
+    if header.get('GROUPS', False) or header.get('NAXIS1') == 0:
+        return 'random groups are not supported'
+    if 'BLANK' in header:
+        return 'BLANK values are not supported'
+    return None
+
+class PrimaryCube(object):
+    """Lazily-scaled view of the data in a FITS primary HDU.
+
+    The raw big-endian data is available as `raw`, a read-only
+    np.memmap in numpy axis order (NAXISn, ..., NAXIS1). Indexing the
+    cube itself returns a native-endian ndarray with BSCALE/BZERO
+    (and any extra `scale`) applied to just the selected slab.
+    """
+
+    def __init__(self, filename, scale=1.):
+        self.filename = filename
+        with open(filename, 'rb') as fitsfile:
+            self.header, self.offset = read_header(fitsfile)
+        reason = _check_header(self.header)
+        if reason is not None:
+            raise RawFitsError('Cannot read %s raw: %s.' % (filename, reason))
+        bitpix = self.header['BITPIX']
+        naxis = self.header['NAXIS']
+        shape = tuple(self.header['NAXIS%d' % n]
+                      for n in range(naxis, 0, -1))
+        self.raw = np.memmap(filename, dtype=_BITPIX2NUMPY[bitpix], mode='r',
+                             offset=self.offset, shape=shape)
+        self.bscale = self.header.get('BSCALE', 1.)*scale
+        self.bzero = self.header.get('BZERO', 0.)*scale
+        if self.bscale == 1 and self.bzero == 0:
+            self.dtype = self.raw.dtype.newbyteorder('=')
+        elif (self.bscale == 1 and
+              _BITPIX2UNSIGNED.get(bitpix, (None,))[0] == self.bzero):
+            # The usual (un)signed integer convention: the offset only
+            # flips the sign bit, so the data stays integer (the cast
+            # and the addition below wrap around)
+            self.dtype = np.dtype(_BITPIX2UNSIGNED[bitpix][1])
+        else:
+            self.dtype = np.dtype(_BITPIX2FLOAT[bitpix])
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    @property
+    def nbytes(self):
+        return self.raw.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        data = np.asarray(self.raw[key]).astype(self.dtype)
+        if self.bscale != 1:
+            data *= self.dtype.type(self.bscale)
+        if self.bzero != 0:
+            data += self.dtype.type(self.bzero)
+        return data
+
+    def close(self):
+        """Release the memory map."""
+        self.raw = None
@@ -1,5 +1,4 @@
-from distutils.core import setup
-import setuptools
+from setuptools import setup
 
 setup(name='pyfits2itk',
       version='0.1',
@@ -7,5 +6,10 @@ setup(name='pyfits2itk',
       author='Jonathan Foster',
       author_email='jonathan.bruce.foster@gmail.com',
       url='http://github.com/jfoster17/pyfits2itk',
-      py_modules=['fits2itk','nrrd','strip_fourth_fits_header'],
-      )
\ No newline at end of file
+      py_modules=['fits2itk','nrrd','rawfits','compfits','fits2itk_service',
+                  'strip_fourth_fits_header'],
+      entry_points={
+          'console_scripts': ['fits2itk = fits2itk:main',
+                              'fits2itk-service = fits2itk_service:main'],
+          },
+      )
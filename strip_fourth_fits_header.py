@@ -14,8 +14,6 @@ strip_fourth_fits_header.py infile outfile 1
 clobber == 1 -> True (overwrites outfile if present)
 
 """
-from astropy.io import fits
-import numpy as np
 import sys
 
 def main():
@@ -35,6 +33,7 @@ def trim_vel(infile,outfile,vmin,vmax):
     Trim the velocity axis
     
     """
+    from astropy.io import fits
     d,h = fits.getdata(infile,header=True)
     d = d[vmin:vmax]
     h['CRPIX3'] = h['CRPIX3']-vmin
@@ -42,6 +41,8 @@ def trim_vel(infile,outfile,vmin,vmax):
 
 
 def strip(infile,outfile,clobber=False):
+    from astropy.io import fits
+    import numpy as np
     d,h = fits.getdata(infile,header=True)
 
     d = np.squeeze(d)
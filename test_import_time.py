@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_import_time.py
+
+Checks that importing fits2itk and running `fits2itk -h` stay cheap:
+astropy, numpy and scipy must not be loaded, and the import has to fit
+in IMPORT_BUDGET seconds. Run with `python -m pytest test_import_time.py`
+or `python test_import_time.py`.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Seconds allowed for `import fits2itk` in a fresh interpreter. Loading
+# astropy alone takes several times this.
+IMPORT_BUDGET = 0.25
+
+HEAVY_MODULES = ['astropy', 'numpy', 'scipy']
+
+_PROBE = """
+import json, sys, time
+start = time.time()
+import fits2itk
+elapsed = time.time() - start
+if %(help)r:
+    sys.argv = ['fits2itk', '-h']
+    stdout = sys.stdout
+    sys.stdout = open(%(devnull)r, 'w')
+    try:
+        fits2itk.main()
+    except SystemExit:
+        pass
+    sys.stdout = stdout
+heavy = [m for m in sys.modules if m.split('.')[0] in %(heavy)r]
+print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))
+"""
+
+def _probe(help=False):
+    """Import fits2itk (and run -h) in a fresh interpreter; returns the
+    import time and the heavy modules that ended up loaded."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = _PROBE % {'help': help, 'devnull': os.devnull,
+                     'heavy': HEAVY_MODULES}
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+    return json.loads(output.decode('ascii').strip().splitlines()[-1])
+
+class ImportTimeTest(unittest.TestCase):
+
+    def test_import_loads_no_heavy_modules(self):
+        self.assertEqual(_probe()['heavy'], [])
+
+    def test_help_loads_no_heavy_modules(self):
+        self.assertEqual(_probe(help=True)['heavy'], [])
+
+    def test_import_within_budget(self):
+        # Best of a few runs, so a busy machine doesn't fail the test
+        elapsed = min(_probe()['elapsed'] for _ in range(3))
+        self.assertTrue(elapsed < IMPORT_BUDGET,
+                        'import fits2itk took %.3fs, budget is %.3fs' %
+                        (elapsed, IMPORT_BUDGET))
+
+
+if __name__ == '__main__':
+    unittest.main()
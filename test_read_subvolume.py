@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_read_subvolume.py
+
+Checks nrrd.read_subvolume and read_slab against numpy slicing of the
+written data, for raw and gzip files (attached and detached), and the
+gzip member index: used when present, built on first read of a
+multi-member file without one, never written for single-member files,
+and ignored when it no longer matches the data.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import nrrd
+
+BOXES = [
+    [None, (3, 4), None],
+    [(2, 9), None, (1, 5)],
+    [None, None, (4, 7)],
+    [None, None, None],
+    [(5, 5), None, None],
+    [(-3, None), (2, 10), (-1, None)],
+    [(1, 2), (1, 2), (1, 2)],
+]
+
+class ReadSubvolumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        self.data = rng.randint(0, 50, size=(17, 13, 11)).astype('i2')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _index(self, name):
+        return self._path(name) + '.gzidx'
+
+    def _check_boxes(self, filename):
+        for box in BOXES:
+            data, header = nrrd.read_subvolume(filename, box)
+            expected = self.data[tuple(slice(*r) if r else slice(None)
+                                       for r in box)]
+            self.assertEqual(data.shape, expected.shape)
+            self.assertTrue(np.array_equal(data, expected), box)
+        data, header = nrrd.read_slab(filename, 2, 6)
+        self.assertTrue(np.array_equal(data, self.data[..., 2:6]))
+
+    def test_encodings(self):
+        for encoding in ('raw', 'gzip', 'bz2'):
+            for name in ('a.nrrd', 'a.nhdr'):
+                nrrd.write(self._path(name), self.data,
+                           {'encoding': encoding})
+                self._check_boxes(self._path(name))
+
+    def test_indexed_gzip(self):
+        for name in ('m.nrrd', 'm.nhdr'):
+            for memberbytes in (7, 300, 10**6):
+                nrrd.write(self._path(name), self.data,
+                           {'encoding': 'gzip'},
+                           gzip_member_bytes=memberbytes)
+                self.assertTrue(os.path.exists(self._index('m.nrrd')))
+                self._check_boxes(self._path(name))
+
+    def test_index_built_on_first_read(self):
+        nrrd.write(self._path('b.nrrd'), self.data, {'encoding': 'gzip'},
+                   gzip_member_bytes=500)
+        os.remove(self._index('b.nrrd'))
+        self._check_boxes(self._path('b.nrrd'))
+        self.assertTrue(os.path.exists(self._index('b.nrrd')))
+        self._check_boxes(self._path('b.nrrd'))
+
+    def test_no_index_for_single_member(self):
+        nrrd.write(self._path('s.nrrd'), self.data, {'encoding': 'gzip'})
+        self._check_boxes(self._path('s.nrrd'))
+        self.assertFalse(os.path.exists(self._index('s.nrrd')))
+
+    def test_stale_index_is_ignored(self):
+        nrrd.write(self._path('t.nrrd'), self.data, {'encoding': 'gzip'},
+                   gzip_member_bytes=300)
+        shutil.copy(self._index('t.nrrd'), self._path('old.gzidx'))
+        self.data = self.data[::-1].copy()
+        nrrd.write(self._path('t.nrrd'), self.data, {'encoding': 'gzip'},
+                   gzip_member_bytes=1000)
+        shutil.copy(self._path('old.gzidx'), self._index('t.nrrd'))
+        self._check_boxes(self._path('t.nrrd'))
+
+    def test_rewrite_removes_index(self):
+        nrrd.write(self._path('r.nrrd'), self.data, {'encoding': 'gzip'},
+                   gzip_member_bytes=300)
+        nrrd.write(self._path('r.nrrd'), self.data, {'encoding': 'raw'})
+        self.assertFalse(os.path.exists(self._index('r.nrrd')))
+
+    def test_wrong_number_of_ranges(self):
+        nrrd.write(self._path('w.nrrd'), self.data, {'encoding': 'raw'})
+        self.assertRaises(nrrd.NrrdError, nrrd.read_subvolume,
+                          self._path('w.nrrd'), [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_shared_volume.py
+
+Checks nrrd.read(..., shared=True) and SharedVolume across processes
+started with fork and with spawn: children that attach see the data
+and are counted, children that only inherit the handle are not, the
+count returns to 0 and the block is removed exactly once, by the last
+release(). Needs Python 3.8 or later.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import nrrd
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+def _attach_child(handle, queue):
+    data, header = handle.attach()
+    queue.put((float(data.sum()), handle._refcount(0)))
+    del data
+    handle.release()
+
+def _release_only_child(handle, queue):
+    # An inherited handle that was never attached here
+    handle.release()
+    queue.put(None)
+
+def _block_exists(name):
+    try:
+        block = shared_memory.SharedMemory(name)
+    except OSError:
+        return False
+    block.close()
+    return True
+
+@unittest.skipIf(shared_memory is None, 'needs Python 3.8 or later')
+class SharedVolumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'shared.nrrd')
+        self.data = np.random.RandomState(2).rand(6, 5, 4)
+        nrrd.write(self.filename, self.data, {'encoding': 'gzip'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, method, target, handle, nchildren=3):
+        context = multiprocessing.get_context(method)
+        queue = context.Queue()
+        children = [context.Process(target=target, args=(handle, queue))
+                    for _ in range(nchildren)]
+        for child in children:
+            child.start()
+        results = [queue.get(timeout=60) for _ in children]
+        for child in children:
+            child.join()
+            self.assertEqual(child.exitcode, 0)
+        return results
+
+    def _check_method(self, method):
+        data, header, handle = nrrd.read(self.filename, shared=True)
+        self.assertTrue(np.array_equal(data, self.data))
+        results = self._run(method, _attach_child, handle)
+        for total, count in results:
+            self.assertAlmostEqual(total, self.data.sum())
+            self.assertTrue(count >= 2)
+        self.assertEqual(handle._refcount(0), 1)
+        if method == 'fork':
+            self._run(method, _release_only_child, handle)
+            self.assertEqual(handle._refcount(0), 1)
+        self.assertTrue(_block_exists(handle.name))
+        del data
+        handle.release()
+        self.assertFalse(_block_exists(handle.name))
+        # Releasing again is harmless
+        handle.release()
+
+    def test_fork(self):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            self.skipTest('fork is not available')
+        self._check_method('fork')
+
+    def test_spawn(self):
+        self._check_method('spawn')
+
+    def test_released_block_is_tolerated(self):
+        data, header, handle = nrrd.read(self.filename, shared=True)
+        other = nrrd.SharedVolume(handle.name, handle.dtype, handle.header)
+        other.attach()
+        # Someone removed the block behind our back
+        shared_memory.SharedMemory(handle.name).unlink()
+        handle.release()
+        other.release()
+        self.assertTrue(np.array_equal(data, self.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_update_header.py
+
+Checks nrrd.update_header: fields are changed in place when the new
+header fits the old one's space (no slack left, or at least 2 bytes to
+pad), the file is rewritten when it doesn't (1 byte of slack can't hold
+a comment line), and detached headers leave the data file alone. The
+data must read back unchanged in every case.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import nrrd
+
+PADDING = 64
+
+class UpdateHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = np.arange(4*5*6, dtype='f4').reshape((4, 5, 6))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, encoding='raw', padding=PADDING):
+        filename = os.path.join(self.tmpdir, name)
+        nrrd.write(filename, self.data,
+                   {'encoding': encoding, 'content': 'a',
+                    'space origin': [0., 0., 0.]},
+                   header_padding=padding)
+        return filename
+
+    def _header_size(self, filename):
+        with open(filename, 'rb') as filehandle:
+            return sum(len(line) for line in
+                       nrrd._read_header_lines(filehandle))
+
+    def _check(self, filename, **fields):
+        data, header = nrrd.read(filename)
+        self.assertTrue(np.array_equal(data, self.data))
+        for field, value in fields.items():
+            self.assertEqual(header[field.replace('_', ' ')], value)
+        return header
+
+    def test_in_place_with_slack(self):
+        for encoding in ('raw', 'gzip'):
+            filename = self._write('slack.nrrd', encoding)
+            size = os.path.getsize(filename)
+            headersize = self._header_size(filename)
+            nrrd.update_header(filename, space_origin=[1.5, -2., 3.25],
+                               keyvaluepairs={'note': 'moved'})
+            self.assertEqual(os.path.getsize(filename), size)
+            self.assertEqual(self._header_size(filename), headersize)
+            header = self._check(filename, space_origin=[1.5, -2., 3.25])
+            self.assertEqual(header['keyvaluepairs'], {'note': 'moved'})
+
+    def test_in_place_without_slack(self):
+        # Grow the content field by exactly the padding line
+        filename = self._write('exact.nrrd')
+        size = os.path.getsize(filename)
+        nrrd.update_header(filename, content='a'*(1 + PADDING))
+        self.assertEqual(os.path.getsize(filename), size)
+        self._check(filename, content='a'*(1 + PADDING))
+        with open(filename, 'rb') as filehandle:
+            lines = nrrd._read_header_lines(filehandle)
+        self.assertFalse([line for line in lines if line.strip() == '#' or
+                          line.startswith(nrrd._HEADER_PADDING_COMMENT)])
+
+    def test_one_byte_slack_rewrites(self):
+        filename = self._write('one.nrrd')
+        size = os.path.getsize(filename)
+        nrrd.update_header(filename, content='a'*PADDING)
+        self.assertEqual(os.path.getsize(filename),
+                         size - 1 + nrrd._DEFAULT_HEADER_PADDING)
+        self._check(filename, content='a'*PADDING)
+
+    def test_no_room_rewrites(self):
+        for padding in (0, PADDING):
+            filename = self._write('full.nrrd', 'gzip', padding)
+            nrrd.update_header(filename, content='b'*(2*PADDING))
+            self._check(filename, content='b'*(2*PADDING))
+            # The rewritten file has room for the next update again
+            size = os.path.getsize(filename)
+            nrrd.update_header(filename, content='c')
+            self.assertEqual(os.path.getsize(filename), size)
+            self._check(filename, content='c')
+
+    def test_detached_header(self):
+        filename = self._write('detached.nhdr')
+        datafilename = filename[:-4] + 'nrrd'
+        with open(datafilename, 'rb') as datafile:
+            before = datafile.read()
+        nrrd.update_header(filename, content='x'*(4*PADDING),
+                           space_origin=[9., 8., 7.])
+        with open(datafilename, 'rb') as datafile:
+            self.assertEqual(datafile.read(), before)
+        self._check(filename, content='x'*(4*PADDING),
+                    space_origin=[9., 8., 7.])
+
+    def test_layout_fields_are_refused(self):
+        filename = self._write('layout.nrrd')
+        self.assertRaises(nrrd.NrrdError, nrrd.update_header, filename,
+                          sizes=[1, 2, 3])
+        self.assertRaises(nrrd.NrrdError, nrrd.update_header, filename,
+                          no_such_field=1)
+        self._check(filename, content='a')
+
+
+if __name__ == '__main__':
+    unittest.main()